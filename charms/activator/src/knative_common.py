@@ -0,0 +1,964 @@
+# Copyright 2020 Camille Rodriguez
+# See LICENSE file for licensing details.
+
+"""Pod spec building blocks shared by the Knative Serving charms.
+
+This module is vendored into the ``src`` directory of every charm, the copies
+must be kept identical.
+
+Each charm describes its component declaratively (ports, environment, probes)
+and builds its pod spec with a single call to ``build_pod_spec``. The static
+fragments of the spec are built once per process and shared between calls, so
+they must never be mutated by the caller.
+
+Resources that pod spec v3 cannot express, such as container resource
+requirements, HorizontalPodAutoscalers and PodDisruptionBudgets, are managed
+through the Kubernetes API with lightkube. This requires the application to be
+trusted (``juju trust``).
+
+Hook handlers decorated with ``timed`` record the duration of their phases
+and the size of the rendered payloads, see ``phase``.
+
+The hooks common to the charms are handled by ``ComponentCharm``, and those of
+the charms related to the controller by ``RelatedComponentCharm``.
+
+The controller charm publishes the settings shared by the components (images,
+ConfigMap names, namespace, feature flags) on the ``knative-serving``
+relation, along with a digest of them. The other charms only parse and render
+them again when the digest changes. The controller also publishes whether the
+CRDs and ConfigMaps of Knative Serving are applied, until then the other charms
+hold back their pod spec, their pods would only crash loop.
+"""
+
+import abc
+import json
+import logging
+import math
+import os
+import re
+import time
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+from hashlib import md5
+
+from oci_image import MissingResourceError, OCIImageResource, OCIImageResourceError
+from ops.charm import CharmBase
+from ops.framework import StoredState
+from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus, WaitingStatus
+
+logger = logging.getLogger(__name__)
+
+METRICS_PORT = 9090
+PROFILING_PORT = 8008
+
+CONFIG_LOGGING_NAME = 'config-logging'
+CONFIG_OBSERVABILITY_NAME = 'config-observability'
+
+# Environment variables filled in by Kubernetes from the pod fields.
+FIELD_ENV = {
+    'POD_NAME': 'metadata.name',
+    'POD_IP': 'status.podIP',
+    'SYSTEM_NAMESPACE': 'metadata.namespace',
+}
+
+
+@lru_cache(maxsize=None)
+def security_context():
+    return {
+        'privileged': False,
+        'readOnlyRootFilesystem': True,
+        'runAsNonRoot': True,
+        'capabilities': {
+            'drop': ['ALL']
+        }
+    }
+
+
+@lru_cache(maxsize=None)
+def prometheus_service(port=METRICS_PORT):
+    """Return the service settings for annotation based Prometheus discovery."""
+    return {
+        'annotations': {
+            'prometheus.io/port': str(port),
+            'prometheus.io/scrape': 'true',
+        }
+    }
+
+
+@lru_cache(maxsize=None)
+def field_ref(path):
+    return {
+        'field': {
+            'path': path
+        }
+    }
+
+
+@lru_cache(maxsize=None)
+def container_port(name, port):
+    return {
+        'containerPort': port,
+        'name': name
+    }
+
+
+@lru_cache(maxsize=None)
+def service_port(name, port, target_port):
+    return {
+        'name': name,
+        'port': port,
+        'targetPort': target_port,
+    }
+
+
+def container_ports(ports, metrics_port=METRICS_PORT, profiling_port=PROFILING_PORT):
+    """Return the metrics and profiling ports followed by ``ports``."""
+    return [
+        container_port('metrics', metrics_port),
+        container_port('profiling', profiling_port),
+    ] + [container_port(name, port) for name, port in ports.items()]
+
+
+def service_ports(ports):
+    """Return the metrics and profiling service ports followed by ``ports``.
+
+    ``ports`` maps the port name to a ``(port, target_port)`` tuple.
+    """
+    return [
+        service_port('http-metrics', METRICS_PORT, METRICS_PORT),
+        service_port('http-profiling', PROFILING_PORT, PROFILING_PORT),
+    ] + [service_port(name, *port) for name, port in ports.items()]
+
+
+def kubelet_probe(component, port, scheme=None, **settings):
+    """Return an HTTP probe sending the ``k-kubelet-probe`` header."""
+    http_get = {'port': port}
+    if scheme:
+        http_get['scheme'] = scheme
+    http_get['httpHeaders'] = [{
+        'name': 'k-kubelet-probe',
+        'value': component,
+    }]
+    return dict(settings, httpGet=http_get)
+
+
+def mirror_image(image, registry):
+    """Return ``image`` pulled from the ``registry`` mirror.
+
+    The registry host of ``image`` is replaced by ``registry``, which may
+    include a path (e.g. ``registry.internal:5000/knative``). ``image`` is
+    returned as is when ``registry`` is empty.
+    """
+    if not registry:
+        return image
+    host, _, path = image.partition('/')
+    if path and ('.' in host or ':' in host or host == 'localhost'):
+        image = path
+    return '{}/{}'.format(registry.rstrip('/'), image)
+
+
+def pull_policy(image, configured=None):
+    """Return the pull policy of ``image``, ``configured`` unless empty.
+
+    Images pinned by digest never change, they are only pulled when missing
+    from the node. ``image`` is an image name or the image details of an OCI
+    image resource.
+    """
+    if configured:
+        return configured
+    path = image['imagePath'] if isinstance(image, dict) else image
+    return 'IfNotPresent' if '@sha256:' in path else 'Always'
+
+
+def build_container(name, image, ports=None, field_env=('POD_NAME', 'SYSTEM_NAMESPACE'),
+                    env=None, metrics_domain='knative.dev/serving',
+                    readiness_probe=None, liveness_probe=None, runtime_env=None,
+                    metrics_port=METRICS_PORT, profiling_port=PROFILING_PORT,
+                    config_logging_name=CONFIG_LOGGING_NAME,
+                    config_observability_name=CONFIG_OBSERVABILITY_NAME,
+                    image_pull_policy=None):
+    """Return the container spec of a Knative Serving component.
+
+    ``image`` is an image name or the image details of an OCI image resource.
+    Probes are given as keyword arguments of ``kubelet_probe``, ``runtime_env``
+    holds the Go runtime variables returned by ``go_env``. Containers sharing
+    a pod must be given distinct metrics and profiling ports.
+    """
+    env_config = dict(env or {})
+    env_config.update(runtime_env or {})
+    if metrics_port != METRICS_PORT:
+        env_config['METRICS_PROMETHEUS_PORT'] = str(metrics_port)
+    if profiling_port != PROFILING_PORT:
+        env_config['PROFILING_PORT'] = str(profiling_port)
+    for var in field_env:
+        env_config[var] = field_ref(FIELD_ENV[var])
+    env_config.update({
+        'CONFIG_LOGGING_NAME': config_logging_name,
+        'CONFIG_OBSERVABILITY_NAME': config_observability_name,
+        'METRICS_DOMAIN': metrics_domain,
+    })
+
+    kubernetes = {'securityContext': security_context()}
+    if readiness_probe:
+        kubernetes['readinessProbe'] = kubelet_probe(name, **readiness_probe)
+    if liveness_probe:
+        kubernetes['livenessProbe'] = kubelet_probe(name, **liveness_probe)
+
+    return {
+        'name': name,
+        'imageDetails' if isinstance(image, dict) else 'image': image,
+        'imagePullPolicy': pull_policy(image, image_pull_policy),
+        'ports': container_ports(ports or {}, metrics_port, profiling_port),
+        'envConfig': env_config,
+        'kubernetes': kubernetes,
+    }
+
+
+def build_pod_spec(image, service_account=None, config_maps=None, sidecars=(), **component):
+    """Return the version 3 pod spec of the component described by ``component``.
+
+    ``component`` holds the keyword arguments of ``build_container``,
+    ``sidecars`` the specs of the containers running next to it.
+    """
+    spec = {'version': 3, 'service': prometheus_service()}
+    if service_account:
+        spec['serviceAccount'] = service_account
+    spec['containers'] = [build_container(image=image, **component)]
+    spec['containers'].extend(sidecars)
+    if config_maps:
+        spec['configMaps'] = config_maps
+    return spec
+
+
+def spec_digest(spec, k8s_resources=None):
+    """Return a digest of the canonical serialisation of a pod spec."""
+    with phase('serialize'):
+        data = json.dumps({
+            'spec': spec,
+            'k8s_resources': k8s_resources,
+        }, sort_keys=True, separators=(',', ':')).encode('utf8')
+    record_size('pod-spec', len(data))
+    return md5(data).hexdigest()
+
+
+def config_digest(config, options, sources=()):
+    """Return a digest of the values of ``options`` in ``config`` and ``sources``."""
+    data = json.dumps({
+        'options': {option: config.get(option) for option in options},
+        'sources': list(sources),
+    }, sort_keys=True, separators=(',', ':'))
+    return md5(data.encode('utf8')).hexdigest()
+
+
+RELATION_NAME = 'knative-serving'
+# Format of the data published on the knative-serving relation, bumped on
+# incompatible changes so that older charms ignore it.
+RELATION_VERSION = '1'
+
+
+def relation_payload(serving_config):
+    """Return the relation data publishing ``serving_config`` with its digest."""
+    data = json.dumps(serving_config, sort_keys=True, separators=(',', ':'))
+    return {
+        'version': RELATION_VERSION,
+        'digest': md5(data.encode('utf8')).hexdigest(),
+        'config': data,
+    }
+
+
+def relation_digest(data):
+    """Return the digest published in the relation ``data``.
+
+    None is returned when nothing was published yet or when it was published
+    in an unknown format.
+    """
+    if data.get('version') != RELATION_VERSION:
+        return None
+    return data.get('digest')
+
+
+def relation_ready(data):
+    """Return whether the controller published the CRDs and ConfigMaps as applied."""
+    return relation_digest(data) is not None and data.get('ready') == 'true'
+
+
+def relation_config(data):
+    """Return the serving config published in the relation ``data``."""
+    return json.loads(data['config'])
+
+
+def published_image(serving_config, name, default, registry=None):
+    """Return the image of component ``name`` published in ``serving_config``.
+
+    The image is pulled from the ``registry`` mirror when set, or else from
+    the mirror published by the controller.
+    """
+    image = serving_config.get('images', {}).get(name, default)
+    return mirror_image(image, registry or serving_config.get('image_registry'))
+
+
+def attached_image(resource, release_image):
+    """Return the image details of the OCI image ``resource``, or None if not attached.
+
+    None is also returned when the image attached is ``release_image``, the
+    ``upstream-source`` Juju attaches by default, so that the charm applies
+    the image mirror and the images published by the controller instead.
+    """
+    try:
+        image = resource.fetch()
+    except MissingResourceError:
+        return None
+    return None if image['imagePath'] == release_image else image
+
+
+def published_container_args(serving_config):
+    """Return the ``build_container`` arguments published in ``serving_config``."""
+    config_maps = serving_config.get('config_maps', {})
+    return {
+        'config_logging_name': config_maps.get('logging', CONFIG_LOGGING_NAME),
+        'config_observability_name': config_maps.get('observability', CONFIG_OBSERVABILITY_NAME),
+    }
+
+
+def validate_serving_config(serving_config, namespace):
+    """Check ``serving_config`` applies to ``namespace``, raises ValueError if not."""
+    published = serving_config.get('namespace')
+    if published and published != namespace:
+        raise ValueError('The controller runs in {}, not in this model'.format(published))
+
+
+METRICS_RELATION_NAME = 'metrics-endpoint'
+
+
+def scrape_jobs(ports=(METRICS_PORT,)):
+    """Return the Prometheus scrape jobs of the units, metrics served on ``ports``."""
+    return [{
+        'metrics_path': '/metrics',
+        # Prometheus replaces the wildcard with the address of every unit.
+        'static_configs': [{'targets': ['*:{}'.format(port) for port in ports]}],
+    }]
+
+
+def publish_scrape_jobs(charm, ports=(METRICS_PORT,)):
+    """Publish the scrape jobs of ``charm`` on every metrics-endpoint relation.
+
+    Every unit publishes its own address, the leader the jobs of the
+    application.
+    """
+    for relation in charm.model.relations[METRICS_RELATION_NAME]:
+        binding = charm.model.get_binding(relation)
+        address = binding.network.ingress_address if binding else None
+        if address is not None:
+            relation.data[charm.unit].update({
+                'prometheus_scrape_unit_address': str(address),
+                'prometheus_scrape_unit_name': charm.unit.name,
+            })
+        if charm.unit.is_leader():
+            relation.data[charm.app].update({
+                'scrape_jobs': json.dumps(scrape_jobs(ports)),
+                'scrape_metadata': json.dumps({
+                    'model': charm.model.name,
+                    'model_uuid': charm.model.uuid,
+                    'application': charm.app.name,
+                    'charm_name': charm.meta.name,
+                }),
+            })
+
+
+# Number of hook timings kept in the stored state of the charms
+TIMINGS_KEPT = 10
+
+# Timings of the hook being handled, None outside of a timed handler
+_timings = None
+
+
+@contextmanager
+def phase(name):
+    """Account the time spent in the enclosed block to phase ``name``."""
+    if _timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases = _timings['phases']
+        phases[name] = phases.get(name, 0) + time.perf_counter() - start
+
+
+def record_size(name, size):
+    """Record the size in bytes of the payload ``name`` of the current hook."""
+    if _timings is not None:
+        _timings['sizes'][name] = size
+
+
+def timed(handler):
+    """Decorate the hook handler ``handler`` to record its phase timings.
+
+    The timings of each hook are logged as a ``hook-timings`` JSON line, the
+    last ``TIMINGS_KEPT`` are kept in ``charm._stored.hook_timings``. Timed
+    handlers called by another one are accounted to the outer hook.
+    """
+    @wraps(handler)
+    def wrapper(charm, event):
+        global _timings
+        if _timings is not None:
+            return handler(charm, event)
+        _timings = {'hook': event.handle.kind, 'phases': {}, 'sizes': {}}
+        start = time.perf_counter()
+        try:
+            return handler(charm, event)
+        finally:
+            timings, _timings = _timings, None
+            timings['total_ms'] = round((time.perf_counter() - start) * 1000, 3)
+            timings['phases'] = {
+                name: round(seconds * 1000, 3) for name, seconds in timings['phases'].items()
+            }
+            line = json.dumps(timings, sort_keys=True)
+            logger.info('hook-timings %s', line)
+            kept = list(charm._stored.hook_timings) + [line]
+            charm._stored.hook_timings = kept[-TIMINGS_KEPT:]
+    return wrapper
+
+
+class KubernetesError(Exception):
+    """Raised when a resource could not be managed through the Kubernetes API."""
+
+
+_MIN_AVAILABLE_RE = re.compile(r'^\d+%?$')
+_REGISTRY_RE = re.compile(r'^[A-Za-z0-9.-]+(:\d+)?(/[A-Za-z0-9._-]+)*/?$')
+PULL_POLICIES = ('Always', 'IfNotPresent', 'Never')
+_QUANTITY_RE = re.compile(r'^(\d+(?:\.\d+)?|\.\d+)(m|k|M|G|T|P|E|Ki|Mi|Gi|Ti|Pi|Ei)?$')
+_QUANTITY_SUFFIXES = {
+    None: 1, 'm': 1e-3,
+    'k': 1e3, 'M': 1e6, 'G': 1e9, 'T': 1e12, 'P': 1e15, 'E': 1e18,
+    'Ki': 2 ** 10, 'Mi': 2 ** 20, 'Gi': 2 ** 30, 'Ti': 2 ** 40, 'Pi': 2 ** 50, 'Ei': 2 ** 60,
+}
+RESOURCES = ('cpu', 'memory')
+
+
+def parse_quantity(value):
+    """Return the numeric value of the Kubernetes quantity string ``value``."""
+    match = _QUANTITY_RE.match(value.strip())
+    if not match:
+        raise ValueError('invalid quantity {!r}'.format(value))
+    number, suffix = match.groups()
+    return float(number) * _QUANTITY_SUFFIXES[suffix]
+
+
+def validate_scaling(config):
+    """Check the replica options of ``config``, raises ValueError if invalid."""
+    if config['min-replicas'] < 1:
+        raise ValueError('min-replicas must be at least 1')
+    if config['max-replicas'] < config['min-replicas']:
+        raise ValueError('max-replicas must be at least min-replicas')
+    if config['target-cpu-utilization'] < 1:
+        raise ValueError('target-cpu-utilization must be at least 1')
+    if scaling_wanted(config) and not config['cpu-request']:
+        # The HPA scales on a percentage of the requested CPU.
+        raise ValueError('max-replicas above 1 requires cpu-request')
+    min_available = config['pdb-min-available']
+    if min_available and not _MIN_AVAILABLE_RE.match(min_available):
+        raise ValueError('pdb-min-available must be a pod count or a percentage')
+
+
+def validate_images(config):
+    """Check the image options of ``config``, raises ValueError if invalid."""
+    if config['image-registry'] and not _REGISTRY_RE.match(config['image-registry']):
+        raise ValueError('image-registry must be a registry host, optionally with a path')
+    if config['image-pull-policy'] and config['image-pull-policy'] not in PULL_POLICIES:
+        raise ValueError('image-pull-policy must be one of {}'.format(', '.join(PULL_POLICIES)))
+
+
+def validate_replicas(config):
+    """Check the replica count of ``config``, raises ValueError if invalid."""
+    if config['replicas'] < 0:
+        raise ValueError('replicas must not be negative')
+
+
+def validate_resources(config):
+    """Check the resource and Go runtime options, raises ValueError if invalid."""
+    for resource in RESOURCES:
+        values = {}
+        for kind in ('request', 'limit'):
+            option = '{}-{}'.format(resource, kind)
+            if config[option]:
+                try:
+                    values[kind] = parse_quantity(config[option])
+                except ValueError:
+                    raise ValueError('{} must be a Kubernetes quantity'.format(option)) from None
+        if len(values) == 2 and values['request'] > values['limit']:
+            raise ValueError('{0}-request must not exceed {0}-limit'.format(resource))
+    if config['gomaxprocs'] < 0:
+        raise ValueError('gomaxprocs must not be negative')
+
+
+def resource_requirements(config):
+    """Return the container resources set in ``config``."""
+    requirements = {}
+    for kind in ('request', 'limit'):
+        values = {
+            resource: config['{}-{}'.format(resource, kind)]
+            for resource in RESOURCES
+            if config['{}-{}'.format(resource, kind)]
+        }
+        if values:
+            requirements[kind + 's'] = values
+    return requirements
+
+
+def go_env(config):
+    """Return the Go runtime environment variables set in ``config``.
+
+    GOMAXPROCS defaults to the CPU limit, rounded up, so the Go scheduler does
+    not run more threads than the container may use and get throttled.
+    """
+    env = {}
+    if config['gogc']:
+        env['GOGC'] = config['gogc']
+    if config['gomemlimit']:
+        env['GOMEMLIMIT'] = config['gomemlimit']
+    gomaxprocs = config['gomaxprocs']
+    if not gomaxprocs and config['cpu-limit']:
+        gomaxprocs = max(1, math.ceil(parse_quantity(config['cpu-limit'])))
+    if gomaxprocs:
+        env['GOMAXPROCS'] = str(gomaxprocs)
+    return env
+
+
+# API versions of the PodDisruptionBudget: policy/v1 is served from
+# Kubernetes 1.21, policy/v1beta1 of the release manifest until 1.25.
+PDB_API_VERSIONS = ('policy/v1', 'policy/v1beta1')
+
+
+def scaling_wanted(config):
+    """Return whether ``config`` asks for an HPA and a PDB."""
+    return config.get('max-replicas', 1) > 1
+
+
+def deployment_patch_wanted(config):
+    """Return whether ``config`` needs resources pod spec v3 cannot express."""
+    return any((
+        scaling_wanted(config),
+        config.get('replicas', 0) > 0,
+        resource_requirements(config),
+    ))
+
+
+def scaling_manifests(name, config, selector, pdb_api_version=PDB_API_VERSIONS[-1]):
+    """Return the HPA and PDB manifests of deployment ``name``.
+
+    A manifest is None when the resource is not wanted: neither exists when
+    a single replica may run, leaving the pod count to ``juju scale-application``.
+    The PDB is in ``pdb_api_version``, the one of the release manifest unless
+    the cluster only serves another.
+    """
+    hpa = None
+    if scaling_wanted(config):
+        hpa = {
+            'apiVersion': 'autoscaling/v1',
+            'kind': 'HorizontalPodAutoscaler',
+            'metadata': {'name': name},
+            'spec': {
+                'minReplicas': config['min-replicas'],
+                'maxReplicas': config['max-replicas'],
+                'scaleTargetRef': {
+                    'apiVersion': 'apps/v1',
+                    'kind': 'Deployment',
+                    'name': name,
+                },
+                # Percentage of the requested CPU
+                'targetCPUUtilizationPercentage': config['target-cpu-utilization'],
+            },
+        }
+    pdb = None
+    min_available = config.get('pdb-min-available')
+    if hpa and min_available:
+        pdb = {
+            'apiVersion': pdb_api_version,
+            'kind': 'PodDisruptionBudget',
+            'metadata': {'name': name + '-pdb'},
+            'spec': {
+                'minAvailable': (min_available if min_available.endswith('%')
+                                 else int(min_available)),
+                'selector': {'matchLabels': selector},
+            },
+        }
+    return hpa, pdb
+
+
+def _pdb_resource(client):
+    # The first API version of PDB_API_VERSIONS served by the cluster, along
+    # with the lightkube resource of the PDB in that version.
+    from lightkube import ApiError
+    from lightkube.generic_resource import create_namespaced_resource
+
+    for api_version in PDB_API_VERSIONS:
+        group, version = api_version.split('/')
+        resource = create_namespaced_resource(
+            group, version, 'PodDisruptionBudget', 'poddisruptionbudgets')
+        try:
+            next(iter(client.list(resource, chunk_size=1)), None)
+        except ApiError as e:
+            if e.status.code != 404:
+                raise
+            continue
+        return api_version, resource
+    raise KubernetesError('No PodDisruptionBudget API served by the cluster')
+
+
+def _quantities(requirements):
+    # The resources of RESOURCES as numbers, the API server may return a
+    # quantity in another unit than the one set (1000m as 1).
+    return {
+        (kind, resource): parse_quantity(str(value))
+        for kind, values in requirements.items()
+        for resource, value in (values or {}).items()
+        if resource in RESOURCES
+    }
+
+
+def _container_resources(deployment, container):
+    for spec in deployment.spec.template.spec.containers:
+        if spec.name == container:
+            resources = spec.resources
+            if resources is None:
+                return {}
+            return {
+                kind: getattr(resources, kind)
+                for kind in ('requests', 'limits')
+                if getattr(resources, kind)
+            }
+    return None
+
+
+def reconcile_deployment(name, namespace, container, config):
+    """Reconcile what pod spec v3 cannot express for deployment ``name``.
+
+    The resources of ``container`` and the ``replicas`` count, unless 0, are
+    patched into the deployment, which Juju replaces whenever the pod spec
+    changes, and the
+    HPA and PDB are applied or deleted when ``config`` has the replica range
+    options.
+
+    Returns False when Juju has not created the deployment yet, in which case
+    the caller should try again on a later hook.
+    """
+    from lightkube import ApiError, Client, ConfigError
+    from lightkube.codecs import from_dict
+    from lightkube.resources.apps_v1 import Deployment
+    from lightkube.resources.autoscaling_v1 import HorizontalPodAutoscaler
+    from lightkube.types import PatchType
+
+    try:
+        client = Client(namespace=namespace, field_manager=name)
+        try:
+            deployment = client.get(Deployment, name)
+        except ApiError as e:
+            if e.status.code == 404:
+                return False
+            raise
+
+        resources = resource_requirements(config)
+        current = _container_resources(deployment, container)
+        if current is not None and _quantities(current) != _quantities(resources):
+            # A strategic merge patch merges the requests and limits key by
+            # key, explicit nulls drop the resources no longer configured.
+            patch = {
+                kind: {resource: resources.get(kind, {}).get(resource) for resource in RESOURCES}
+                for kind in ('requests', 'limits')
+            }
+            client.patch(Deployment, name, {
+                'spec': {'template': {'spec': {'containers': [
+                    {'name': container, 'resources': patch},
+                ]}}},
+            }, patch_type=PatchType.STRATEGIC)
+
+        # With 0 the pod count is left to juju scale-application.
+        replicas = config.get('replicas')
+        if replicas and deployment.spec.replicas != replicas:
+            client.patch(Deployment, name, {'spec': {'replicas': replicas}},
+                         patch_type=PatchType.MERGE)
+
+        if 'max-replicas' not in config:
+            return True
+        pdb_api_version, pdb_resource = _pdb_resource(client)
+        hpa, pdb = scaling_manifests(name, config, deployment.spec.selector.matchLabels,
+                                     pdb_api_version)
+        for resource, resource_name, manifest in (
+            (HorizontalPodAutoscaler, name, hpa),
+            (pdb_resource, name + '-pdb', pdb),
+        ):
+            if manifest:
+                client.apply(from_dict(manifest))
+                continue
+            try:
+                client.delete(resource, resource_name)
+            except ApiError as e:
+                if e.status.code != 404:
+                    raise
+    except (ApiError, ConfigError) as e:
+        raise KubernetesError(str(e)) from e
+    return True
+
+
+def missing_resources(namespace, crds, config_maps):
+    """Return the CRDs and ConfigMaps not applied to the cluster yet.
+
+    A CRD only counts as applied once the API server established it. The
+    names of the missing ``crds`` are returned first, followed by those of
+    the missing ``config_maps`` of ``namespace``.
+    """
+    from lightkube import ApiError, Client, ConfigError
+    from lightkube.resources.apiextensions_v1 import CustomResourceDefinition
+    from lightkube.resources.core_v1 import ConfigMap
+
+    try:
+        client = Client(namespace=namespace)
+        established = {
+            crd.metadata.name for crd in client.list(CustomResourceDefinition)
+            if any(condition.type == 'Established' and condition.status == 'True'
+                   for condition in (crd.status.conditions if crd.status else None) or ())
+        }
+        applied = {config_map.metadata.name for config_map in client.list(ConfigMap)}
+    except (ApiError, ConfigError) as e:
+        raise KubernetesError(str(e)) from e
+    missing = sorted(set(crds) - established)
+    missing.extend(sorted(set(config_maps) - applied))
+    return missing
+
+
+K8S_BLOCKED_STATUS = BlockedStatus(
+    'Unable to manage Kubernetes resources, is the application trusted?')
+CONTROLLER_WAITING_STATUS = WaitingStatus(
+    'Waiting for the controller to apply the CRDs and ConfigMaps')
+
+
+class ComponentCharm(CharmBase, metaclass=abc.ABCMeta):
+    """Base of the charm of a Knative Serving component.
+
+    Subclasses describe their component in ``COMPONENT``, the arguments of
+    ``build_pod_spec``, and render the pod spec in ``_on_start``. Only the
+    leader renders it, every unit publishes its address to Prometheus.
+    """
+
+    _stored = StoredState()
+    COMPONENT = None
+    # Hook rendering the pod spec for the first time
+    FIRST_HOOK = 'install'
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.framework.observe(
+            self.on[METRICS_RELATION_NAME].relation_joined,
+            self._on_metrics_endpoint_relation_joined,
+        )
+        # Actions run on the unit they are invoked on, leader or not.
+        self.framework.observe(self.on.hook_timings_action, self._on_hook_timings_action)
+        self._observe_actions()
+        if not self.unit.is_leader():
+            self.unit.status = WaitingStatus("Waiting for leadership")
+            return
+        self.image = OCIImageResource(self, 'knative-{}-image'.format(self.COMPONENT['name']))
+        self.framework.observe(getattr(self.on, self.FIRST_HOOK), self._on_start)
+        self.framework.observe(self.on.config_changed, self._on_config_changed)
+        self.framework.observe(self.on.upgrade_charm, self._on_upgrade_charm)
+        self.framework.observe(self.on.update_status, self._on_update_status)
+        self._observe()
+        # --- initialize states ---
+        self._stored.set_default(config_hash=self._config_hash())
+        self._stored.set_default(spec_digest=None)
+        self._stored.set_default(deployment_patched=False)
+        self._stored.set_default(hook_timings=[])
+        # -- base values --
+        self._stored.set_default(namespace=os.environ["JUJU_MODEL_NAME"])
+
+    def _observe_actions(self):
+        """Observe the actions of the charm on top of hook-timings, on every unit."""
+
+    def _observe(self):
+        """Observe the events the leader handles on top of the common ones."""
+
+    @abc.abstractmethod
+    def _on_start(self, event):
+        """Render the pod spec and push it to Juju if it changed."""
+
+    def _config_hash(self):
+        data = json.dumps(dict(self.model.config), sort_keys=True)
+        return md5(data.encode('utf8')).hexdigest()
+
+    def _on_upgrade_charm(self, event):
+        # The new revision may render another pod spec from the same inputs,
+        # _set_spec_if_changed only pushes it if it does.
+        self._on_start(event)
+
+    @timed
+    def _on_config_changed(self, event):
+        current_config_hash = self._config_hash()
+        if current_config_hash == self._stored.config_hash:
+            # Nothing changed since the configuration was last checked.
+            return
+        self._stored.config_hash = current_config_hash
+        self._on_start(event)
+
+    def _metrics_ports(self):
+        return (METRICS_PORT,)
+
+    def _on_metrics_endpoint_relation_joined(self, event):
+        publish_scrape_jobs(self, self._metrics_ports())
+
+    def _on_hook_timings_action(self, event):
+        """Return the phase timings of the last hooks, oldest first."""
+        if not self.unit.is_leader():
+            event.fail('Hook timings are only recorded on the leader unit')
+            return
+        timings = list(self._stored.hook_timings)[-event.params['count']:]
+        event.set_results({'timings': '[{}]'.format(', '.join(timings))})
+
+    def _set_spec_if_changed(self, spec, k8s_resources=None):
+        """Push the pod spec to Juju unless it is identical to the last one pushed."""
+        digest = spec_digest(spec, k8s_resources)
+        if digest == self._stored.spec_digest:
+            logger.debug('Pod spec unchanged, skipping set_spec')
+            return
+        with phase('set-spec'):
+            self.model.pod.set_spec(spec, k8s_resources=k8s_resources)
+        self._stored.spec_digest = digest
+
+    def _reconcile_deployment(self):
+        """Apply the resources, replicas, HPA and PDB, which pod spec v3 cannot express."""
+        wanted = deployment_patch_wanted(self.model.config)
+        if not (wanted or self._stored.deployment_patched):
+            # Nothing to create nor to clean up, no need for API access.
+            return True
+        try:
+            with phase('kubernetes-api'):
+                patched = reconcile_deployment(
+                    self.app.name, self._stored.namespace, self.COMPONENT['name'],
+                    self.model.config,
+                )
+        except KubernetesError:
+            logger.exception('Unable to reconcile the deployment')
+            self.unit.status = K8S_BLOCKED_STATUS
+            return False
+        if patched:
+            self._stored.deployment_patched = wanted
+        else:
+            logger.info('Deployment not created yet, retrying on update-status')
+        return True
+
+    def _on_update_status(self, event):
+        if self._reconcile_deployment() and self.unit.status == K8S_BLOCKED_STATUS:
+            self.unit.status = ActiveStatus("Ready")
+
+
+class RelatedComponentCharm(ComponentCharm):
+    """Base of the charm of a component configured by the controller.
+
+    The settings published by the controller on the ``knative-serving``
+    relation are stored along with their digest, the pod spec is rendered
+    again when they change. Subclasses set the ``IMAGE`` of the release and
+    describe the Kubernetes resources of the pod spec in ``_k8s_resources``.
+
+    The pod spec is first rendered on start rather than install: the
+    relation-created events of the relations present at deploy time fire in
+    between, so a charm deployed along with the controller knows it has to
+    wait for it.
+    """
+
+    IMAGE = None
+    FIRST_HOOK = 'start'
+
+    def _observe(self):
+        serving = self.on[RELATION_NAME]
+        self.framework.observe(serving.relation_changed, self._on_serving_relation_changed)
+        self.framework.observe(serving.relation_broken, self._on_serving_relation_broken)
+        self._stored.set_default(serving_digest=None)
+        self._stored.set_default(serving_config={})
+        self._stored.set_default(serving_ready=False)
+
+    @timed
+    def _on_start(self, event):
+        """Occurs upon install, start, upgrade, and possibly config changed."""
+        try:
+            self._check_config()
+        except ValueError as e:
+            self.unit.status = BlockedStatus(str(e))
+            return
+        if not self._controller_ready():
+            # Pushed once the controller publishes the resources as applied.
+            self.unit.status = CONTROLLER_WAITING_STATUS
+            return
+        self.unit.status = MaintenanceStatus(
+            "Installing Knative {}...".format(self.COMPONENT['name'].capitalize()))
+        try:
+            image_info = self._image()
+        except OCIImageResourceError:
+            logger.exception('An error occured while fetching the image info')
+            self.unit.status = BlockedStatus("Error fetching image information")
+            return
+
+        with phase('spec-build'):
+            spec = build_pod_spec(
+                image_info,
+                runtime_env=go_env(self.model.config),
+                image_pull_policy=self.model.config['image-pull-policy'],
+                **published_container_args(self._stored.serving_config),
+                **self._spec_args(),
+                **self.COMPONENT,
+            )
+        self._set_spec_if_changed(spec, k8s_resources=self._k8s_resources())
+        if not self._reconcile_deployment():
+            return
+        self.unit.status = ActiveStatus("Ready")
+
+    def _spec_args(self):
+        """Return the ``build_pod_spec`` arguments depending on the charm state."""
+        return {}
+
+    @abc.abstractmethod
+    def _k8s_resources(self):
+        """Return the Kubernetes resources of the pod spec."""
+
+    def _image(self):
+        """Return the image resource attached, or else the image of the release."""
+        return attached_image(self.image, self.IMAGE) or published_image(
+            self._stored.serving_config,
+            self.COMPONENT['name'],
+            self.IMAGE,
+            registry=self.model.config['image-registry'],
+        )
+
+    def _controller_ready(self):
+        """Return whether the pods can start, the controller applies what they need."""
+        if not self.model.relations[RELATION_NAME]:
+            return True
+        return self._stored.serving_ready
+
+    def _check_config(self):
+        """Raise ValueError describing the first invalid option."""
+        validate_images(self.model.config)
+        validate_serving_config(self._stored.serving_config, self._stored.namespace)
+        validate_resources(self.model.config)
+
+    @timed
+    def _on_serving_relation_changed(self, event):
+        """Render again when the controller publishes different settings or readiness."""
+        data = event.relation.data[event.app] if event.app else {}
+        digest = relation_digest(data)
+        ready = relation_ready(data)
+        if digest == self._stored.serving_digest and ready == self._stored.serving_ready:
+            logger.debug('Published settings unchanged, skipping render')
+            return
+        self._stored.serving_digest = digest
+        self._stored.serving_ready = ready
+        self._stored.serving_config = relation_config(data) if digest else {}
+        self._on_start(event)
+
+    @timed
+    def _on_serving_relation_broken(self, event):
+        """Fall back to the settings of the release."""
+        self._stored.serving_digest = None
+        self._stored.serving_config = {}
+        self._stored.serving_ready = False
+        self._on_start(event)
@@ -3,133 +3,115 @@
 # See LICENSE file for licensing details.
 
 import logging
-import json
-from hashlib import md5
-import os
-from pathlib import Path
-import yaml
 
-# from oci_image import OCIImageResource, OCIImageResourceError
-
-from ops.charm import CharmBase
-from ops.framework import StoredState
 from ops.main import main
-from ops.model import (
-    ActiveStatus,
-    BlockedStatus,
-    MaintenanceStatus,
-    WaitingStatus,
-)
+
+import knative_common
 
 logger = logging.getLogger(__name__)
 
+# Image of the release, unless the controller publishes another one
+IMAGE = (
+    'gcr.io/knative-releases/knative.dev/serving/cmd/autoscaler'
+    '@sha256:db6ceff2aab47083b36c0e24ab0c0eea6f070bc8e7c82dae828778c6714fe1fb'
+)
+
+COMPONENT = {
+    'name': 'autoscaler',
+    'ports': {'websocket': 8080},
+    'field_env': ('POD_NAME', 'POD_IP', 'SYSTEM_NAMESPACE'),
+    'readiness_probe': {'port': 8080, 'failureThreshold': 12},
+    'liveness_probe': {'port': 8080, 'initialDelaySeconds': 15, 'failureThreshold': 12},
+}
+
+# Stats pushed by the activator and the queue-proxies reach the autoscaler
+# through this service.
+SERVICE = {
+    'name': 'autoscaler',
+    'spec': {
+        'ports': knative_common.service_ports({'http': (8080, 8080)}),
+        'selector': {'app': 'autoscaler'},
+    },
+}
+
+POD = {
+    'labels': {'app': 'autoscaler'},
+    # Evicting the autoscaler pauses the scaling of every revision.
+    'annotations': {'cluster-autoscaler.kubernetes.io/safe-to-evict': 'false'},
+}
 
-class ServingAutoscalerCharm(CharmBase):
-    _stored = StoredState()
-
-    def __init__(self, *args):
-        super().__init__(*args)
-        if not self.unit.is_leader():
-            self.unit.status = WaitingStatus("Waiting for leadership")
-            return
-        # self.image = OCIImageResource(self, 'knative-activator-image')
-        self.framework.observe(self.on.install, self._on_start)
-        # self.framework.observe(self.on.config_changed, self._on_config_changed)
-        # --- initialize states ---
-        # self._stored.set_default(config_hash=self._config_hash())
-        self._stored.set_default(started=False)
-        # -- base values --
-        self._stored.set_default(namespace=os.environ["JUJU_MODEL_NAME"])
-    
-    def _on_start(self, event):
-        """Occurs upon install, start, upgrade, and possibly config changed."""
-        if self._stored.started:
-            return
-        self.unit.status = MaintenanceStatus("Installing Knative Autoscaler...")
-        # try:
-            #image_info = self.image.fetch()
-        image_info = "gcr.io/knative-releases/knative.dev/serving/cmd/autoscaler@sha256:db6ceff2aab47083b36c0e24ab0c0eea6f070bc8e7c82dae828778c6714fe1fb"
-        # except OCIImageResourceError:
-        #     logging.exception('An error occured while fetching the image info')
-        #     self.unit.status = BlockedStatus("Error fetching image information")
-        #     return
-
-        self.model.pod.set_spec(
-            {
-                'version': 3,
-                'containers': [{
-                    'name': 'autoscaler',
-                    'image': image_info,
-                    # 'imageDetails': image_info,
-                    'imagePullPolicy': 'Always',
-                    'ports': [{
-                        'containerPort': 9090,
-                        'name': 'metrics'
-                        },
-                        {
-                        'containerPort': 8008,
-                        'name': 'profiling'
-                        },
-                        {
-                        'containerPort': 8080,
-                        'name': 'websocket'
-                        },
-                    ],
-                    'envConfig': {
-                        'POD_NAME':{
-                            'field': {
-                                'path': "metadata.name"
-                            }
-                        },
-                        'POD_IP':{
-                            'field': {
-                                'path': "status.podIP"
-                            }
-                        },
-                        'SYSTEM_NAMESPACE':{
-                            'field': {
-                                'path': "metadata.namespace"
-                            }
-                        },
-                        'CONFIG_LOGGING_NAME':'config-logging',
-                        'CONFIG_OBSERVABILITY_NAME': 'config-observability',
-                        'METRICS_DOMAIN':'knative.dev/serving',
-                    },
-                    'kubernetes': {
-                        'securityContext': {
-                            'privileged': False,
-                            'readOnlyRootFilesystem': True,
-                            'runAsNonRoot': True,
-                            'capabilities': {
-                                'drop': ['ALL']
-                            }
-                        },
-                        'readinessProbe': {
-                            'httpGet': {
-                                'port': 8080,
-                                'httpHeaders': [{
-                                    'name': 'k-kubelet-probe',
-                                    'value': 'autoscaler',
-                                }],
-                            },
-                            'failureThreshold': 12
-                        },
-                        'livenessProbe': {
-                            'initialDelaySeconds': 15,
-                            'failureThreshold': 12,
-                            'httpGet': {
-                                'port': 8080,
-                                'httpHeaders': [{
-                                    'name': 'k-kubelet-probe',
-                                    'value': 'autoscaler',
-                                }],
-                            }
-                        }
-                    },
-                }],
+_ALL_VERBS = ['get', 'list', 'watch', 'create', 'update', 'patch', 'delete']
+
+# Rules of the resources the autoscaler reconciles or reads. With several
+# replicas, each leader election bucket is held through a lease and exposed
+# by a service and endpoints of its own, to which the other replicas forward
+# the stats of the revisions in that bucket.
+RULES = [
+    {
+        'apiGroups': ['autoscaling.internal.knative.dev'],
+        'resources': ['podautoscalers', 'podautoscalers/status', 'metrics', 'metrics/status'],
+        'verbs': _ALL_VERBS,
+    },
+    {
+        'apiGroups': ['networking.internal.knative.dev'],
+        'resources': ['serverlessservices', 'serverlessservices/status'],
+        'verbs': _ALL_VERBS,
+    },
+    {
+        'apiGroups': ['serving.knative.dev'],
+        'resources': ['revisions'],
+        'verbs': ['get', 'list', 'watch'],
+    },
+    {
+        'apiGroups': ['apps'],
+        'resources': ['deployments', 'deployments/scale'],
+        'verbs': ['get', 'list', 'watch', 'update', 'patch'],
+    },
+    {
+        'apiGroups': [''],
+        'resources': ['pods', 'configmaps', 'namespaces'],
+        'verbs': ['get', 'list', 'watch'],
+    },
+    {
+        'apiGroups': [''],
+        'resources': ['services', 'endpoints', 'events'],
+        'verbs': _ALL_VERBS,
+    },
+    {
+        'apiGroups': ['coordination.k8s.io'],
+        'resources': ['leases'],
+        'verbs': _ALL_VERBS,
+    },
+]
+
+
+class ServingAutoscalerCharm(knative_common.RelatedComponentCharm):
+    COMPONENT = COMPONENT
+    IMAGE = IMAGE
+
+    def _spec_args(self):
+        return {
+            'service_account': {
+                'roles': [{'name': 'autoscaler', 'global': True, 'rules': RULES}],
             },
-        )
-        self.unit.status = ActiveStatus("Ready")
+        }
+
+    def _k8s_resources(self):
+        return {
+            'kubernetesResources': {
+                'services': [SERVICE],
+                'pod': POD,
+            }
+        }
+
+    def _check_config(self):
+        """Raise ValueError describing the first invalid option."""
+        super()._check_config()
+        knative_common.validate_replicas(self.model.config)
+        buckets = self._stored.serving_config.get('leader_election_buckets', 1)
+        if self.model.config['replicas'] > buckets:
+            logger.warning('More replicas than the %s leader election buckets set on the '
+                           'controller, the extra replicas only act as standby', buckets)
 
 
 if __name__ == "__main__":
@@ -3,223 +3,390 @@
 # See LICENSE file for licensing details.
 
 import logging
-import json
-from hashlib import md5
-import os
-from pathlib import Path
-import yaml
 
-# from oci_image import OCIImageResource, OCIImageResourceError
+from oci_image import OCIImageResourceError
 
-from ops.charm import CharmBase
-from ops.framework import StoredState
 from ops.main import main
 from ops.model import (
     ActiveStatus,
     BlockedStatus,
     MaintenanceStatus,
-    WaitingStatus,
 )
 
+# The modules rendering the pod spec are imported by the methods using them,
+# hooks with nothing to render never load them.
+import knative_common
+
 logger = logging.getLogger(__name__)
 
+COMPONENT = {
+    'name': 'controller',
+    'metrics_domain': 'knative.dev/internal/serving',
+}
 
-class ServingControllerCharm(CharmBase):
-    _stored = StoredState()
+# Components whose images are published on the knative-serving relation
+PUBLISHED_IMAGES = ('activator', 'autoscaler', 'webhook')
 
-    def __init__(self, *args):
-        super().__init__(*args)
-        if not self.unit.is_leader():
-            self.unit.status = WaitingStatus("Waiting for leadership")
-            return
-        # self.image = OCIImageResource(self, 'knative-controller-image')
-        self.framework.observe(self.on.install, self._on_start)
-        self.framework.observe(self.on.config_changed, self._on_config_changed)
-        # --- initialize states ---
-        self._stored.set_default(config_hash=self._config_hash())
-        self._stored.set_default(started=False)
-        # -- base values --
-        self._stored.set_default(namespace=os.environ["JUJU_MODEL_NAME"])
-
-    def _config_hash(self):
-        data = json.dumps({
-            'networking-layer': self.model.config['networking-layer'],
-        }, sort_keys=True)
-        return md5(data.encode('utf8')).hexdigest()
-    
+# Charm options the pod spec is rendered from, by section, along with the
+# ConfigMap options of configmaps.OPTIONS. The other options only affect the
+# deployment patched through the Kubernetes API. Keep in sync with the
+# options read by the renders.
+RENDER_OPTIONS = (
+    # serviceAccount, containers and configMaps
+    'networking-layer', 'image-registry',
+    # containers
+    'image-pull-policy', 'cpu-limit', 'gogc', 'gomemlimit', 'gomaxprocs',
+    # configMaps
+    'slim-configmaps',
+    # k8s_resources
+    'crd-schema-mode',
+)
+
+
+class ServingControllerCharm(knative_common.ComponentCharm):
+    COMPONENT = COMPONENT
+
+    def _observe_actions(self):
+        self.framework.observe(self.on.gc_policy_action, self._on_gc_policy_action)
+        self.framework.observe(
+            self.on.simulate_autoscaler_action, self._on_simulate_autoscaler_action
+        )
+
+    def _observe(self):
+        self.framework.observe(
+            self.on[knative_common.RELATION_NAME].relation_created,
+            self._on_serving_relation_created,
+        )
+        self.framework.observe(self.framework.on.pre_commit, self._on_pre_commit)
+        self._stored.set_default(render_digest=None)
+        self._stored.set_default(ready=False)
+
+    @knative_common.timed
     def _on_start(self, event):
         """Occurs upon install, start, upgrade, and possibly config changed."""
-        if self._stored.started:
+        try:
+            self._check_config()
+        except ValueError as e:
+            self.unit.status = BlockedStatus(str(e))
             return
         self.unit.status = MaintenanceStatus("Installing Knative...")
-        # try:
-            #image_info = self.image.fetch()
-        image_info = "gcr.io/knative-releases/knative.dev/serving/cmd/controller@sha256:b2cd45b8a8a4747efbb24443240ac7836b1afc64207da837417862479d2e84c5"
-        # except OCIImageResourceError:
-        #     logging.exception('An error occured while fetching the image info')
-        #     self.unit.status = BlockedStatus("Error fetching image information")
-        #     return
-
-        self.model.pod.set_spec(
-            {
-                'version': 3,
-                'serviceAccount': {
-                    'roles': [{
-                        # ClusterRole knative-serving-namespaced-admin
-                        'name': 'namespaced-admin',
-                        'global': True,
-                        'rules': [
-                            {
-                                'apiGroups': ['serving.knative.dev'],
-                                'resources': ['*'],
-                                'verbs': ['*'],
-                            },
-                            {
-                                'apiGroups': ["networking.internal.knative.dev", "autoscaling.internal.knative.dev", "caching.internal.knative.dev"],
-                                'resources': ['*'],
-                                'verbs': ["get", "list", "watch"],
-                            },
-                        ],
-                    },
-                    {
-                    # ClusterRole knative-serving-admin
-                        'name': "admin",
-                        'global': True,
-                        'rules': [{
-                                'apiGroups': ['serving.knative.dev'],
-                                'resources': ['*'],
-                                'verbs': ['list'],
-                            },] # Rules are automatically filled in by the controller manager.
-                    }
-                ],
-                },
-                'containers': [{
-                    'name': 'controller',
-                    'image': image_info,
-                    # 'imageDetails': image_info,
-                    'imagePullPolicy': 'Always',
-                    'ports': [{
-                        'containerPort': 9090,
-                        'name': 'metrics'
-                        },
-                        {
-                        'containerPort': 8008,
-                        'name': 'profiling'
-                        },
-                    ],
-                    'envConfig': {
-                        'POD_NAME':{
-                            'field': {
-                                'path': "metadata.name"
-                            }
-                        },
-                        'SYSTEM_NAMESPACE':{
-                            'field': {
-                                'path': "metadata.namespace"
-                            }
-                        },
-                        'CONFIG_LOGGING_NAME':'config-logging',
-                        'CONFIG_OBSERVABILITY_NAME': 'config-observability',
-                        'METRICS_DOMAIN':'knative.dev/internal/serving',
-                    },
-                    'kubernetes': {
-                        'securityContext': {
-                            'privileged': False,
-                            'readOnlyRootFilesystem': True,
-                            'runAsNonRoot': True,
-                            'capabilities': {
-                                'drop': ['ALL']
-                            }
-                        },
-                    },
-                }],
-                # 'service': {
-                #     'annotations': {
-                #         'prometheus.io/port': '7472',
-                #         'prometheus.io/scrape': 'true'
-                #     }
-                # },
-                'configMaps': {
-                    'config-autoscaler': {
-                        'example': open("files/configmaps/cm-autoscaler-example.txt").read()
-                    },
-                    'config-defaults': {
-                        'example': open("files/configmaps/cm-defaults-example.txt").read()
-                    },
-                    'config-deployment': {
-                        'example': open("files/configmaps/cm-deployment-example.txt").read(),
-                        'queueSidecarImage': 'gcr.io/knative-releases/knative.dev/serving/cmd/queue@sha256:1a569afd4c34e285f6d647633925e2b684899bc8d01b4894047c90b75ca49357'
-                    },
-                    'config-domain': {
-                        'example': open("files/configmaps/cm-domain-example.txt").read()
-                    },
-                    'config-features': {
-                        'example': open("files/configmaps/cm-features-example.txt").read()
-                    },
-                    'config-gc': {
-                        'example': open("files/configmaps/cm-gc-example.txt").read()
-                    },
-                    'config-leader-election': {
-                        'example': open("files/configmaps/cm-leader-election-example.txt").read()
-                    },
-                    'config-logging': {
-                        'example': open("files/configmaps/cm-logging-example.txt").read()
-                    },
-                    'config-network': {
-                        'example': open("files/configmaps/cm-network-example.txt").read()
-                    },
-                    'config-observability': {
-                        'example': open("files/configmaps/cm-observability-example.txt").read()
-                    },
-                    'config-tracing': {
-                        'example': open("files/configmaps/cm-tracing-example.txt").read()
-                    },
-                }
-            },
+        try:
+            image_info = self._image()
+        except OCIImageResourceError:
+            logger.exception('An error occured while fetching the image info')
+            self.unit.status = BlockedStatus("Error fetching image information")
+            return
+        self._render(image_info)
+        self._publish()
+        if not self._reconcile_deployment():
+            return
+        self.unit.status = ActiveStatus("Ready")
+
+    def _on_upgrade_charm(self, event):
+        # The render digest only covers the inputs, not the code of the charm.
+        self._stored.render_digest = None
+        super()._on_upgrade_charm(event)
 
+    def _render(self, image_info):
+        """Push the pod spec unless nothing it is rendered from changed.
+
+        The pod spec is hashed over the options, source files and image it is
+        rendered from. Other options, such as the container resources patched
+        through the Kubernetes API, skip the render entirely. The hash is
+        dropped on upgrade-charm, the new revision may render differently.
+        """
+        import configmaps
+        import manifest
+
+        sources = (
+            manifest.cache_key(self._manifest),
+            manifest.cache_key(self._crds_source),
+            image_info,
+        )
+        digest = knative_common.config_digest(
+            self.model.config, RENDER_OPTIONS + tuple(configmaps.OPTIONS), sources)
+        if self._stored.spec_digest and digest == self._stored.render_digest:
+            logger.debug('Nothing the pod spec is rendered from changed, skipping render')
+            return
+        config_maps = self._config_maps()
+        with knative_common.phase('spec-build'):
+            spec = knative_common.build_pod_spec(
+                image_info,
+                service_account=self._service_account(),
+                config_maps=config_maps,
+                sidecars=self._networking().sidecars,
+                runtime_env=knative_common.go_env(self.model.config),
+                image_pull_policy=self.model.config['image-pull-policy'],
+                **COMPONENT,
+            )
+        self._set_spec_if_changed(
+            spec,
             k8s_resources=self.k8s_resources_fixed()
-            # Workaround for bug LP:1910820
-            # {
-            # 'kubernetesResources': {
-            #     'customResourceDefinitions': [
-            #         {'name': crd['metadata']['name'], 'spec': crd['spec']}
-            #         for crd in yaml.safe_load_all(Path("files/serving-crds.yaml").read_text())
-            #     ]
-            # }
-            # }
         )
-        self.unit.status = ActiveStatus("Ready")
+        self._stored.render_digest = digest
+
+    def _image(self):
+        """Return the image resource attached, or else the image of the release."""
+        import manifest
+
+        release_image = manifest.container_image(self._manifest, 'controller', 'controller')
+        return knative_common.attached_image(self.image, release_image) or \
+            knative_common.mirror_image(release_image, self.model.config['image-registry'])
+
+    def _serving_config(self):
+        """Return the settings shared with the other Knative Serving charms."""
+        import configmaps
+        import manifest
+
+        return {
+            'namespace': self._stored.namespace,
+            # Images of the release, mirrored by the charms using them.
+            'images': {
+                name: manifest.container_image(self._manifest, name, name)
+                for name in PUBLISHED_IMAGES
+            },
+            'image_registry': self.model.config['image-registry'],
+            'config_maps': {
+                'logging': knative_common.CONFIG_LOGGING_NAME,
+                'observability': knative_common.CONFIG_OBSERVABILITY_NAME,
+            },
+            'features': configmaps.options_data(self.model.config).get('config-features', {}),
+            'leader_election_buckets': configmaps.buckets(self.model.config),
+        }
+
+    def _publish(self):
+        """Publish the shared settings and the scrape jobs on the relations."""
+        knative_common.publish_scrape_jobs(self, self._metrics_ports())
+        relations = self.model.relations[knative_common.RELATION_NAME]
+        if not relations:
+            return
+        payload = knative_common.relation_payload(self._serving_config())
+        # Left out of the digest, the settings do not change with it.
+        payload['ready'] = 'true' if self._stored.ready else 'false'
+        for relation in relations:
+            relation.data[self.app].update(payload)
+
+    def _on_pre_commit(self, event):
+        """Publish the CRDs and ConfigMaps as applied, checked at the end of every hook.
+
+        Juju applies them once the hook pushing the pod spec commits, they are
+        found by one of the hooks following it rather than by update-status.
+        """
+        if self._stored.ready:
+            return
+        if not (self._stored.spec_digest and self.model.relations[knative_common.RELATION_NAME]):
+            # Nothing applied yet or no charm waiting, kept cheap as it runs
+            # at the end of every hook.
+            return
+        try:
+            self._check_config()
+        except ValueError:
+            # Published once the configuration is fixed.
+            return
+        if self._update_readiness():
+            self._publish()
+
+    def _update_readiness(self):
+        """Record whether the CRDs and ConfigMaps are applied, returns True once they are.
+
+        The other charms wait for them before pushing their pod spec, their pods
+        would otherwise crash loop until the controller catches up.
+        """
+        if self._stored.ready:
+            return True
+        import configmaps
+
+        custom_resource_definitions = \
+            self.k8s_resources_fixed()['kubernetesResources']['customResourceDefinitions']
+        try:
+            with knative_common.phase('kubernetes-api'):
+                missing = knative_common.missing_resources(
+                    self._stored.namespace,
+                    [crd['name'] for crd in custom_resource_definitions],
+                    configmaps.CONFIG_MAPS,
+                )
+        except knative_common.KubernetesError:
+            # Juju applies them along with the pod spec, waiting for a check
+            # that cannot succeed would hold back the other charms forever.
+            logger.warning('Unable to check the CRDs and ConfigMaps, assuming they are applied',
+                           exc_info=True)
+            missing = []
+        if missing:
+            logger.info('Waiting for %s to be applied', ', '.join(missing))
+            return False
+        self._stored.ready = True
+        return True
+
+    def _metrics_ports(self):
+        import networking
+
+        ports = (knative_common.METRICS_PORT,)
+        try:
+            sidecars = self._networking().sidecars
+        except ValueError:
+            # Invalid networking layer, reported by the leader.
+            sidecars = ()
+        if sidecars:
+            ports += (networking.SIDECAR_METRICS_PORT,)
+        return ports
+
+    def _on_serving_relation_created(self, event):
+        try:
+            self._check_config()
+        except ValueError:
+            # Published once the configuration is fixed.
+            return
+        self._publish()
+
+    def _check_config(self):
+        """Raise ValueError describing the first invalid option."""
+        import configmaps
+        import crds
+        import networking
+
+        networking.plugin(self.model.config['networking-layer'])
+        knative_common.validate_images(self.model.config)
+        if self.model.config['crd-schema-mode'] not in crds.SCHEMA_MODES:
+            raise ValueError(
+                'crd-schema-mode must be one of {}'.format(', '.join(crds.SCHEMA_MODES)))
+        configmaps.options_data(self.model.config)
+        knative_common.validate_resources(self.model.config)
+        knative_common.validate_replicas(self.model.config)
+        if self.model.config['replicas'] > configmaps.buckets(self.model.config):
+            logger.warning('More replicas than leader election buckets, '
+                           'the extra replicas only act as standby')
+
+    @property
+    def _manifest(self):
+        return self.charm_dir / "files/serving-core.yaml"
+
+    @property
+    def _crds_source(self):
+        return self.charm_dir / "files/serving-crds.yaml"
+
+    def _networking(self):
+        import networking
+
+        return networking.resources(
+            self.model.config['networking-layer'],
+            self.model.config['image-registry'],
+            self.model.config['image-pull-policy'],
+        )
+
+    def _service_account(self):
+        import manifest
+
+        roles = {
+            'roles': [
+                {
+                    # ClusterRole knative-serving-namespaced-admin
+                    'name': 'namespaced-admin',
+                    'global': True,
+                    'rules': manifest.load(
+                        self._manifest, 'ClusterRole', 'knative-serving-namespaced-admin'
+                    )['rules'],
+                },
+                {
+                    # ClusterRole knative-serving-admin, whose rules are
+                    # aggregated from the ClusterRoles labelled for the
+                    # controller, leader election leases included.
+                    'name': 'admin',
+                    'global': True,
+                    'rules': manifest.aggregated_rules(self._manifest, 'knative-serving-admin'),
+                },
+            ],
+        }
+        if self._networking().rules:
+            roles['roles'].append({
+                # Resources of the networking layer managed by its controller
+                'name': 'networking',
+                'global': True,
+                'rules': self._networking().rules,
+            })
+        return roles
+
+    def _config_maps(self):
+        import configmaps
+        import manifest
+
+        data = configmaps.options_data(self.model.config)
+        data.setdefault('config-network', {}).update(self._networking().config_network)
+        if self.model.config['image-registry']:
+            # Injected next to every revision pod by the controller.
+            deployment = manifest.load(self._manifest, 'ConfigMap', 'config-deployment')
+            data.setdefault('config-deployment', {})['queueSidecarImage'] = \
+                knative_common.mirror_image(
+                    deployment['data']['queueSidecarImage'], self.model.config['image-registry'])
+        with knative_common.phase('configmap-read'):
+            config_maps = configmaps.render(
+                self._manifest,
+                data=data,
+                slim=self.model.config['slim-configmaps'],
+            )
+        # Watched by the controller of the networking layer.
+        for name, layer_data in self._networking().config_maps.items():
+            config_maps[name] = dict(layer_data)
+        return config_maps
 
     def k8s_resources_fixed(self):
-        #Workaround for bug LP:1910820
-        #Remove extra fields under version
-        fields_to_remove = ['additionalPrinterColumns', 'schema', 'subresources'] 
-        
-        k8s_resources_fixed={
+        # Workaround for bug LP:1910820
+        # The fields of every version are filtered once when the CRDs are
+        # compiled, the compiled list is then reused until the source changes.
+        import crds
+
+        with knative_common.phase('crd-load'):
+            custom_resource_definitions = crds.load_crds(
+                self._crds_source,
+                self.charm_dir / "files/serving-crds.compiled.json",
+                mode=self.model.config['crd-schema-mode'],
+            )
+        return {
             'kubernetesResources': {
-                'customResourceDefinitions': [
-                    {'name': crd['metadata']['name'], 'spec': crd['spec']}
-                    for crd in yaml.safe_load_all(Path("files/serving-crds.yaml").read_text())
-                ]
+                'customResourceDefinitions': custom_resource_definitions,
             }
         }
-        for i in range(0,len(k8s_resources_fixed['kubernetesResources']['customResourceDefinitions'])):
-            for field in fields_to_remove:
-                k8s_resources_fixed['kubernetesResources']['customResourceDefinitions'][i]['spec']['versions'][0].pop(field)
 
+    def _on_gc_policy_action(self, event):
+        """Return the revision garbage collection policy in effect."""
+        import configmaps
 
-        return k8s_resources_fixed
+        try:
+            event.set_results(configmaps.gc_policy(self.model.config))
+        except ValueError as e:
+            event.fail(str(e))
 
-    def _on_config_changed(self, event):
-        net_choices = ['ambassador', 'contour', 'gloo', 'istio', 'kong', 'kourier']
-        if self.model.config['networking-layer'].lower() not in net_choices:
-            self.unit.status = BlockedStatus('Invalid networking layer selected')
+    def _on_simulate_autoscaler_action(self, event):
+        """Replay a trace through a model of the autoscaler, see kpa_simulator."""
+        import configmaps
+        import kpa_simulator
+        import yaml
+
+        try:
+            overrides = yaml.safe_load(event.params['config']) or {}
+        except yaml.YAMLError:
+            event.fail('config is not valid YAML')
+            return
+        if not isinstance(overrides, dict):
+            event.fail('config must be a mapping of charm options')
+            return
+        try:
+            # Checked against config.yaml as juju config would.
+            kpa_simulator.check_overrides(overrides, kpa_simulator.option_types(self.charm_dir))
+            settings = kpa_simulator.settings(
+                configmaps.autoscaler_settings(dict(self.model.config, **overrides)))
+            with open(event.params['trace'], newline='') as f:
+                trace = kpa_simulator.read_trace(f, event.params['service-time'])
+        except OSError as e:
+            event.fail('Unable to read the trace: {}'.format(e.strerror))
+            return
+        except ValueError as e:
+            event.fail(str(e))
+            return
+        except (AttributeError, TypeError):
+            event.fail('config does not match the types of the charm options')
             return
-        current_config_hash = self._config_hash()
-        if current_config_hash != self._stored.config_hash:
-            self._stored.started = False
-            self._stored.config_hash = current_config_hash
-            self._on_start(event)
+        result = kpa_simulator.simulate(trace, settings, event.params['cold-start'])
+        event.set_results(kpa_simulator.summary(result))
 
 
 if __name__ == "__main__":
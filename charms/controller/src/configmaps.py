@@ -0,0 +1,402 @@
+# Copyright 2020 Camille Rodriguez
+# See LICENSE file for licensing details.
+
+"""Registry of the Knative Serving ConfigMaps rendered by the controller charm.
+
+Every ConfigMap starts from the data of its upstream counterpart in the
+release manifest, including the documented ``_example`` configuration. In
+slim mode the examples are left out of the pod spec entirely.
+
+Charm options listed in ``OPTIONS`` are validated and rendered as real keys of
+their ConfigMap, options left unset keep the Knative defaults.
+"""
+
+import re
+from collections import namedtuple
+
+import knative_common
+import manifest
+
+CONFIG_MAPS = (
+    'config-autoscaler',
+    'config-defaults',
+    'config-deployment',
+    'config-domain',
+    'config-features',
+    'config-gc',
+    'config-leader-election',
+    'config-logging',
+    'config-network',
+    'config-observability',
+    'config-tracing',
+)
+
+EXAMPLE_KEY = '_example'
+METRICS_BACKENDS = ('prometheus', 'opencensus', 'stackdriver')
+DISABLED = 'disabled'
+
+_REGISTRY_RE = re.compile(r'[A-Za-z0-9]([A-Za-z0-9.-]*[A-Za-z0-9])?(:\d+)?$')
+_DURATION_RE = re.compile(r'(\d+(?:\.\d*)?|\.\d+)(ns|us|µs|ms|s|m|h)')
+_DURATION_UNITS = {
+    'ns': 1e-9, 'us': 1e-6, 'µs': 1e-6, 'ms': 1e-3, 's': 1, 'm': 60, 'h': 3600,
+}
+
+
+def parse_duration(value):
+    """Return the number of seconds of the Go duration string ``value``."""
+    value = value.strip()
+    if value == '0':
+        return 0.0
+    if not value or _DURATION_RE.sub('', value):
+        raise ValueError('invalid duration {!r}'.format(value))
+    return sum(float(number) * _DURATION_UNITS[unit]
+               for number, unit in _DURATION_RE.findall(value))
+
+
+def _number(minimum=None, maximum=None, exclusive_minimum=None):
+    def validate(value):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError('not a number')
+        if minimum is not None and value < minimum:
+            raise ValueError('must be at least {}'.format(minimum))
+        if exclusive_minimum is not None and value <= exclusive_minimum:
+            raise ValueError('must be greater than {}'.format(exclusive_minimum))
+        if maximum is not None and value > maximum:
+            raise ValueError('must be at most {}'.format(maximum))
+        return str(value)
+    return validate
+
+
+def _duration(minimum=0, maximum=None, whole_seconds=False):
+    def validate(value):
+        seconds = parse_duration(value)
+        if seconds < minimum:
+            raise ValueError('must be at least {}s'.format(minimum))
+        if maximum is not None and seconds > maximum:
+            raise ValueError('must be at most {}s'.format(maximum))
+        if whole_seconds and seconds != int(seconds):
+            raise ValueError('must be in whole seconds')
+        return value.strip()
+    return validate
+
+
+def _quantity(value):
+    try:
+        knative_common.parse_quantity(value)
+    except ValueError:
+        raise ValueError('must be a Kubernetes quantity') from None
+    return value.strip()
+
+
+def _registries(value):
+    registries = [registry.strip() for registry in value.split(',')]
+    for registry in registries:
+        if not _REGISTRY_RE.match(registry):
+            raise ValueError('invalid registry {!r}'.format(registry))
+    return ','.join(registries)
+
+
+def _or_disabled(validate):
+    # Revision GC limits accept the special value "disabled".
+    def validate_or_disabled(value):
+        if isinstance(value, str) and value.strip() == DISABLED:
+            return DISABLED
+        return validate(value)
+    return validate_or_disabled
+
+
+def _count(value):
+    try:
+        count = int(value)
+    except ValueError:
+        raise ValueError('must be a number of revisions') from None
+    if count < 0:
+        raise ValueError('must not be negative')
+    return str(count)
+
+
+def _boolean(value):
+    return 'true' if value else 'false'
+
+
+def _choice(*choices):
+    def validate(value):
+        if value not in choices:
+            raise ValueError('must be one of {}'.format(', '.join(choices)))
+        return value
+    return validate
+
+
+Option = namedtuple('Option', ['config_map', 'key', 'validate'])
+
+# Charm option -> ConfigMap key it is rendered into
+OPTIONS = {
+    'container-concurrency-target-percentage': Option(
+        'config-autoscaler', 'container-concurrency-target-percentage',
+        _number(exclusive_minimum=0, maximum=100)),
+    'container-concurrency-target-default': Option(
+        'config-autoscaler', 'container-concurrency-target-default',
+        _number(exclusive_minimum=0)),
+    'requests-per-second-target-default': Option(
+        'config-autoscaler', 'requests-per-second-target-default',
+        _number(exclusive_minimum=1)),
+    'target-burst-capacity': Option(
+        'config-autoscaler', 'target-burst-capacity', _number(minimum=-1)),
+    'stable-window': Option(
+        'config-autoscaler', 'stable-window',
+        _duration(minimum=6, maximum=3600, whole_seconds=True)),
+    'panic-window-percentage': Option(
+        'config-autoscaler', 'panic-window-percentage', _number(minimum=1, maximum=100)),
+    'panic-threshold-percentage': Option(
+        'config-autoscaler', 'panic-threshold-percentage', _number(minimum=110, maximum=1000)),
+    'max-scale-up-rate': Option(
+        'config-autoscaler', 'max-scale-up-rate', _number(exclusive_minimum=1)),
+    'max-scale-down-rate': Option(
+        'config-autoscaler', 'max-scale-down-rate', _number(exclusive_minimum=1)),
+    'enable-scale-to-zero': Option(
+        'config-autoscaler', 'enable-scale-to-zero', _boolean),
+    'scale-to-zero-grace-period': Option(
+        'config-autoscaler', 'scale-to-zero-grace-period', _duration(minimum=6)),
+    'scale-to-zero-pod-retention-period': Option(
+        'config-autoscaler', 'scale-to-zero-pod-retention-period', _duration()),
+    'pod-autoscaler-class': Option(
+        'config-autoscaler', 'pod-autoscaler-class',
+        _choice('kpa.autoscaling.knative.dev', 'hpa.autoscaling.knative.dev')),
+    'activator-capacity': Option(
+        'config-autoscaler', 'activator-capacity', _number(minimum=1)),
+    'initial-scale': Option(
+        'config-autoscaler', 'initial-scale', _number(minimum=0)),
+    'allow-zero-initial-scale': Option(
+        'config-autoscaler', 'allow-zero-initial-scale', _boolean),
+    'max-scale': Option(
+        'config-autoscaler', 'max-scale', _number(minimum=0)),
+    'scale-down-delay': Option(
+        'config-autoscaler', 'scale-down-delay', _duration(maximum=3600)),
+    'max-scale-limit': Option(
+        'config-autoscaler', 'max-scale-limit', _number(minimum=0)),
+    'revision-timeout-seconds': Option(
+        'config-defaults', 'revision-timeout-seconds', _number(minimum=1)),
+    'max-revision-timeout-seconds': Option(
+        'config-defaults', 'max-revision-timeout-seconds', _number(minimum=1)),
+    'container-concurrency': Option(
+        'config-defaults', 'container-concurrency', _number(minimum=0)),
+    'container-concurrency-max-limit': Option(
+        'config-defaults', 'container-concurrency-max-limit', _number(exclusive_minimum=1)),
+    'queue-sidecar-cpu-request': Option(
+        'config-deployment', 'queueSidecarCPURequest', _quantity),
+    'queue-sidecar-cpu-limit': Option(
+        'config-deployment', 'queueSidecarCPULimit', _quantity),
+    'queue-sidecar-memory-request': Option(
+        'config-deployment', 'queueSidecarMemoryRequest', _quantity),
+    'queue-sidecar-memory-limit': Option(
+        'config-deployment', 'queueSidecarMemoryLimit', _quantity),
+    'queue-sidecar-ephemeral-storage-request': Option(
+        'config-deployment', 'queueSidecarEphemeralStorageRequest', _quantity),
+    'queue-sidecar-ephemeral-storage-limit': Option(
+        'config-deployment', 'queueSidecarEphemeralStorageLimit', _quantity),
+    'registries-skipping-tag-resolving': Option(
+        'config-deployment', 'registriesSkippingTagResolving', _registries),
+    'digest-resolution-timeout': Option(
+        'config-deployment', 'digestResolutionTimeout', _duration(minimum=1)),
+    'progress-deadline': Option(
+        'config-deployment', 'progressDeadline', _duration(minimum=1)),
+    'retain-since-create-time': Option(
+        'config-gc', 'retain-since-create-time', _or_disabled(_duration())),
+    'retain-since-last-active-time': Option(
+        'config-gc', 'retain-since-last-active-time', _or_disabled(_duration())),
+    'min-non-active-revisions': Option(
+        'config-gc', 'min-non-active-revisions', _number(minimum=0)),
+    'max-non-active-revisions': Option(
+        'config-gc', 'max-non-active-revisions', _or_disabled(_count)),
+    'metrics-backend': Option(
+        'config-observability', 'metrics.backend-destination', _choice(*METRICS_BACKENDS)),
+    'request-metrics-backend': Option(
+        'config-observability', 'metrics.request-metrics-backend-destination',
+        _choice(*METRICS_BACKENDS)),
+    'enable-request-log': Option(
+        'config-observability', 'logging.enable-request-log', _boolean),
+    'enable-profiling': Option(
+        'config-observability', 'profiling.enable', _boolean),
+    'leader-election-buckets': Option(
+        'config-leader-election', 'buckets', _number(minimum=1, maximum=10)),
+    'leader-election-lease-duration': Option(
+        'config-leader-election', 'leaseDuration', _duration(minimum=1)),
+    'leader-election-renew-deadline': Option(
+        'config-leader-election', 'renewDeadline', _duration(minimum=1)),
+    'leader-election-retry-period': Option(
+        'config-leader-election', 'retryPeriod', _duration(minimum=1)),
+}
+
+# Knative defaults of the autoscaler, as listed in the example of config-autoscaler
+AUTOSCALER_DEFAULTS = {
+    'container-concurrency-target-percentage': '70',
+    'container-concurrency-target-default': '100',
+    'requests-per-second-target-default': '200',
+    'target-burst-capacity': '200',
+    'stable-window': '60s',
+    'panic-window-percentage': '10.0',
+    'panic-threshold-percentage': '200.0',
+    'max-scale-up-rate': '1000.0',
+    'max-scale-down-rate': '2.0',
+    'enable-scale-to-zero': 'true',
+    'scale-to-zero-grace-period': '30s',
+    'scale-to-zero-pod-retention-period': '0s',
+    'pod-autoscaler-class': 'kpa.autoscaling.knative.dev',
+    'activator-capacity': '100.0',
+    'initial-scale': '1',
+    'allow-zero-initial-scale': 'false',
+    'max-scale': '0',
+    'scale-down-delay': '0s',
+    'max-scale-limit': '0',
+}
+
+# Charm options the autoscaler settings are rendered from
+AUTOSCALER_OPTIONS = tuple(
+    name for name, option in OPTIONS.items() if option.config_map == 'config-autoscaler'
+) + ('container-concurrency',)
+
+# Knative defaults of the revision timeout and concurrency limits
+_DEFAULTS_DEFAULTS = {
+    'revision-timeout-seconds': '300',
+    'max-revision-timeout-seconds': '600',
+    'container-concurrency': '0',
+    'container-concurrency-max-limit': '1000',
+}
+
+# Knative defaults of the queue-proxy sidecar resources, the others are unset
+_QUEUE_SIDECAR_DEFAULTS = {'queueSidecarCPURequest': '25m'}
+_QUEUE_SIDECAR_RESOURCES = {
+    'cpu': ('queueSidecarCPURequest', 'queueSidecarCPULimit'),
+    'memory': ('queueSidecarMemoryRequest', 'queueSidecarMemoryLimit'),
+    'ephemeral-storage': (
+        'queueSidecarEphemeralStorageRequest', 'queueSidecarEphemeralStorageLimit'),
+}
+
+# Knative defaults of the revision garbage collection
+GC_DEFAULTS = {
+    'retain-since-create-time': '48h',
+    'retain-since-last-active-time': '15h',
+    'min-non-active-revisions': '20',
+    'max-non-active-revisions': '1000',
+}
+
+# Knative defaults of the leader election timings
+_LEADER_ELECTION_DEFAULTS = {
+    'leaseDuration': '15s',
+    'renewDeadline': '10s',
+    'retryPeriod': '2s',
+}
+
+
+def _check_autoscaler(data):
+    autoscaler = data.get('config-autoscaler', {})
+    allow_zero = autoscaler.get('allow-zero-initial-scale') == 'true'
+    if autoscaler.get('initial-scale') == '0' and not allow_zero:
+        raise ValueError('Invalid initial-scale: 0 requires allow-zero-initial-scale')
+
+
+def _check_defaults(data):
+    defaults = dict(_DEFAULTS_DEFAULTS, **data.get('config-defaults', {}))
+    if int(defaults['revision-timeout-seconds']) > int(defaults['max-revision-timeout-seconds']):
+        raise ValueError('Invalid revision-timeout-seconds: must be at most '
+                         'max-revision-timeout-seconds')
+    if int(defaults['container-concurrency']) > int(defaults['container-concurrency-max-limit']):
+        raise ValueError('Invalid container-concurrency: must be at most '
+                         'container-concurrency-max-limit')
+
+
+def _check_queue_sidecar(data):
+    deployment = dict(_QUEUE_SIDECAR_DEFAULTS, **data.get('config-deployment', {}))
+    for resource, (request, limit) in _QUEUE_SIDECAR_RESOURCES.items():
+        if request not in deployment or limit not in deployment:
+            continue
+        if knative_common.parse_quantity(deployment[request]) > \
+                knative_common.parse_quantity(deployment[limit]):
+            raise ValueError('Invalid queue-sidecar-{0}-limit: must be at least the '
+                             'queue-sidecar-{0}-request'.format(resource))
+
+
+def _check_gc(data):
+    gc = dict(GC_DEFAULTS, **data.get('config-gc', {}))
+    maximum = gc['max-non-active-revisions']
+    if maximum != DISABLED and int(gc['min-non-active-revisions']) > int(maximum):
+        raise ValueError('Invalid min-non-active-revisions: must be at most '
+                         'max-non-active-revisions')
+
+
+def _check_leader_election(data):
+    timings = dict(_LEADER_ELECTION_DEFAULTS, **data.get('config-leader-election', {}))
+    lease = parse_duration(timings['leaseDuration'])
+    renew = parse_duration(timings['renewDeadline'])
+    retry = parse_duration(timings['retryPeriod'])
+    if not lease > renew > retry:
+        raise ValueError('Invalid leader election timings: lease duration must exceed '
+                         'renew deadline, which must exceed retry period')
+
+
+def buckets(config):
+    """Return the number of leader election buckets set in ``config``."""
+    return config.get('leader-election-buckets') or 1
+
+
+def options_data(config):
+    """Return the ConfigMap keys set through the charm options in ``config``.
+
+    Raises ValueError naming the offending option when a value is invalid.
+    """
+    data = {}
+    for name, option in OPTIONS.items():
+        value = config.get(name)
+        if value is None or value == '':
+            continue
+        try:
+            rendered = option.validate(value)
+        except ValueError as e:
+            raise ValueError('Invalid {}: {}'.format(name, e)) from None
+        data.setdefault(option.config_map, {})[option.key] = rendered
+    _check_autoscaler(data)
+    _check_defaults(data)
+    _check_queue_sidecar(data)
+    _check_gc(data)
+    _check_leader_election(data)
+    return data
+
+
+def gc_policy(config):
+    """Return the revision garbage collection settings in effect with ``config``.
+
+    The options left unset are reported with their Knative defaults. Raises
+    ValueError when an option is invalid.
+    """
+    return dict(GC_DEFAULTS, **options_data(config).get('config-gc', {}))
+
+
+def render(manifest_path, data=None, slim=False):
+    """Return the ``configMaps`` section of the pod spec.
+
+    ``data`` maps ConfigMap names to the keys set on top of the upstream data
+    of the release manifest ``manifest_path``.
+    """
+    data = data or {}
+    config_maps = {}
+    for name in CONFIG_MAPS:
+        config_map = dict(manifest.load(manifest_path, 'ConfigMap', name).get('data') or {})
+        if slim:
+            config_map.pop(EXAMPLE_KEY, None)
+        config_map.update(data.get(name, {}))
+        config_maps[name] = config_map
+    return config_maps
+
+
+def autoscaler_settings(config):
+    """Return the autoscaler settings in effect with ``config``.
+
+    The config-autoscaler keys left unset are reported with their Knative
+    defaults, along with the ``container-concurrency`` of config-defaults.
+    Raises ValueError when an option is invalid.
+    """
+    data = options_data(config)
+    settings = dict(AUTOSCALER_DEFAULTS, **data.get('config-autoscaler', {}))
+    settings['container-concurrency'] = data.get('config-defaults', {}).get(
+        'container-concurrency', _DEFAULTS_DEFAULTS['container-concurrency'])
+    return settings
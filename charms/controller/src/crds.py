@@ -0,0 +1,142 @@
+# Copyright 2020 Camille Rodriguez
+# See LICENSE file for licensing details.
+
+"""Compiled cache of the CustomResourceDefinitions shipped with the charm.
+
+Parsing ``serving-crds.yaml`` with PyYAML is by far the most expensive part of
+rendering the controller pod spec. The stripped CRD list is therefore compiled
+once into a JSON snapshot keyed by the content hash of the source file, and
+only regenerated when the YAML changes. The snapshot can be produced at build
+time by running this module directly, otherwise it is written on first use.
+
+Juju rejects some fields of the CRD versions (LP:1910820). Every version goes
+through the field policy of the selected schema mode:
+
+* ``strip`` removes the schema, subresources and printer columns, the
+  historical workaround;
+* ``minimal`` only removes the printer columns and the descriptions of the
+  schemas, so the API server keeps validating and pruning the resources and
+  serving their status subresource;
+* ``full`` ships the versions untouched.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sys
+from collections import namedtuple
+from pathlib import Path
+
+import yaml
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever the compiled format or the field policies change, so stale
+# snapshots from a previous charm revision are not reused.
+CACHE_FORMAT = 2
+
+Policy = namedtuple('Policy', ['remove', 'strip_descriptions'])
+
+# Schema mode -> fields removed from every version, and whether the
+# descriptions of the kept schemas are stripped
+SCHEMA_MODES = {
+    'strip': Policy(('additionalPrinterColumns', 'schema', 'subresources'), False),
+    'minimal': Policy(('additionalPrinterColumns',), True),
+    'full': Policy((), False),
+}
+DEFAULT_SCHEMA_MODE = 'strip'
+
+# Keywords of an OpenAPI schema holding a schema, a list or a map of schemas
+_SCHEMA_KEYWORDS = ('items', 'additionalProperties', 'not')
+_SCHEMA_LIST_KEYWORDS = ('allOf', 'anyOf', 'oneOf')
+_SCHEMA_MAP_KEYWORDS = ('properties', 'patternProperties')
+
+# Compiled CRD lists already loaded by this process, keyed by cache key.
+_loaded = {}
+
+
+def _loader():
+    # The C loader is an order of magnitude faster but only available when
+    # PyYAML was built against libyaml.
+    return getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def cache_key(raw, mode=DEFAULT_SCHEMA_MODE):
+    """Return the cache key of the CRD source file content ``raw``."""
+    return '{}:{}:{}'.format(CACHE_FORMAT, mode, hashlib.sha256(raw).hexdigest())
+
+
+def strip_descriptions(schema):
+    """Remove the descriptions of the OpenAPI ``schema`` and its subschemas, in place."""
+    if not isinstance(schema, dict):
+        return
+    schema.pop('description', None)
+    for keyword in _SCHEMA_KEYWORDS:
+        strip_descriptions(schema.get(keyword))
+    for keyword in _SCHEMA_LIST_KEYWORDS:
+        for subschema in schema.get(keyword, ()):
+            strip_descriptions(subschema)
+    for keyword in _SCHEMA_MAP_KEYWORDS:
+        for subschema in schema.get(keyword, {}).values():
+            strip_descriptions(subschema)
+
+
+def apply_policy(version, policy):
+    """Apply the field ``policy`` to the CRD ``version``, in place."""
+    for field in policy.remove:
+        version.pop(field, None)
+    if policy.strip_descriptions:
+        strip_descriptions(version.get('schema', {}).get('openAPIV3Schema'))
+
+
+def compile_crds(raw, mode=DEFAULT_SCHEMA_MODE):
+    """Parse the CRD source ``raw`` into the list expected by the pod spec."""
+    policy = SCHEMA_MODES[mode]
+    crds = []
+    for crd in yaml.load_all(raw, Loader=_loader()):
+        if not crd:
+            continue
+        for version in crd['spec'].get('versions', ()):
+            apply_policy(version, policy)
+        crds.append({'name': crd['metadata']['name'], 'spec': crd['spec']})
+    return crds
+
+
+def _write_cache(cache, key, crds):
+    tmp = cache.with_name(cache.name + '.tmp')
+    try:
+        tmp.write_text(json.dumps({'key': key, 'crds': crds}, separators=(',', ':')))
+        os.replace(str(tmp), str(cache))
+    except OSError:
+        logger.warning('Unable to write compiled CRD cache %s', cache, exc_info=True)
+
+
+def load_crds(source, cache, mode=DEFAULT_SCHEMA_MODE):
+    """Return the CRDs of ``source`` in schema ``mode``, compiled through ``cache``.
+
+    The returned list is shared between callers and must not be mutated.
+    """
+    raw = Path(source).read_bytes()
+    key = cache_key(raw, mode)
+    if key in _loaded:
+        return _loaded[key]
+
+    cache = Path(cache)
+    try:
+        compiled = json.loads(cache.read_text())
+    except (OSError, ValueError):
+        compiled = {}
+    if compiled.get('key') == key:
+        crds = compiled['crds']
+    else:
+        logger.info('Compiling CRDs from %s', source)
+        crds = compile_crds(raw, mode)
+        _write_cache(cache, key, crds)
+    _loaded[key] = crds
+    return crds
+
+
+if __name__ == '__main__':
+    # Build-time compilation: crds.py <serving-crds.yaml> <compiled.json> [mode]
+    load_crds(*sys.argv[1:4])
@@ -0,0 +1,357 @@
+# Copyright 2020 Camille Rodriguez
+# See LICENSE file for licensing details.
+
+"""Offline model of the Knative Pod Autoscaler (KPA).
+
+A traffic trace is replayed second by second through a model of the KPA of
+Knative Serving v0.19 configured with the keys of config-autoscaler, so that
+a tuning can be evaluated before it reaches a cluster:
+
+* the concurrency observed by the autoscaler, queued requests included, is
+  averaged over the stable and panic windows every ``TICK`` seconds;
+* the desired pod count is bounded by the scale up and down rates, held while
+  panicking and during ``scale-down-delay``, and only drops to zero after the
+  grace period;
+* new pods serve after a fixed cold start, requests beyond the capacity of the
+  ready pods wait in a queue.
+
+The window averages are read from running prefix sums of the observed
+concurrency, each step costs the same whatever the window sizes, so day long
+traces at one second resolution replay in a few seconds.
+
+The trace is a CSV file with one row per second and a ``rps`` column holding
+the requests received in that second. The concurrency they add is read from a
+``concurrency`` column when present, or else derived from the service time.
+
+The model can be run offline: ``kpa_simulator.py <trace.csv> [option=value...]``
+with the autoscaler options of the charm overriding the Knative defaults,
+validated as ``juju config`` would.
+"""
+
+import csv
+import json
+import math
+import sys
+from collections import namedtuple
+from pathlib import Path
+
+import yaml
+
+from configmaps import AUTOSCALER_DEFAULTS, AUTOSCALER_OPTIONS, autoscaler_settings, \
+    parse_duration
+
+# Interval between two autoscaler decisions, in seconds
+TICK = 2
+
+Settings = namedtuple('Settings', [
+    'target', 'total', 'target_burst_capacity', 'stable_window', 'panic_window',
+    'panic_threshold', 'max_scale_up_rate', 'max_scale_down_rate', 'scale_to_zero',
+    'scale_to_zero_wait', 'initial_scale', 'max_scale', 'scale_down_delay',
+])
+
+Trace = namedtuple('Trace', ['rps', 'concurrency'])
+
+# Directory of the charm, holding its config.yaml
+CHARM_DIR = Path(__file__).resolve().parent.parent
+
+# Juju option type -> Python types of its values, and how they are named
+_TYPES = {
+    'string': ((str,), 'a string'),
+    'int': ((int,), 'an integer'),
+    'float': ((int, float), 'a number'),
+    'boolean': ((bool,), 'a boolean'),
+}
+
+# Per second series of a simulation, see ``summary``
+Result = namedtuple('Result', [
+    'rps', 'observed', 'desired', 'ready', 'scheduled', 'panic', 'activator', 'delay',
+    'pods_started',
+])
+
+
+def option_types(charm_dir=CHARM_DIR):
+    """Return the Juju type of each option declared in the config.yaml of ``charm_dir``."""
+    with open(Path(charm_dir) / 'config.yaml') as f:
+        options = yaml.safe_load(f)['options']
+    return {name: option['type'] for name, option in options.items()}
+
+
+def check_overrides(overrides, types):
+    """Raise ValueError unless ``overrides`` maps autoscaler options to values of their type.
+
+    ``types`` maps the charm options to their Juju type, see ``option_types``.
+    """
+    unknown = sorted(set(overrides) - set(AUTOSCALER_OPTIONS), key=str)
+    if unknown:
+        raise ValueError('Not an autoscaler option: {}'.format(', '.join(map(str, unknown))))
+    for name, value in overrides.items():
+        accepted, described = _TYPES[types[name]]
+        # bool is an int to Python, not to Juju.
+        if isinstance(value, bool) != (types[name] == 'boolean') or \
+                not isinstance(value, accepted):
+            raise ValueError('Invalid {}: must be {}'.format(name, described))
+
+
+def parse_overrides(arguments, types):
+    """Return the options of the ``option=value`` command line ``arguments``.
+
+    Values are converted to the Juju type of their option in ``types``, raises
+    ValueError when an option is unknown or a value does not convert.
+    """
+    overrides = {}
+    for argument in arguments:
+        name, separator, value = argument.partition('=')
+        if not separator:
+            raise ValueError('Expected option=value, got {!r}'.format(argument))
+        if name not in AUTOSCALER_OPTIONS:
+            raise ValueError('Not an autoscaler option: {}'.format(name))
+        kind = types[name]
+        try:
+            if kind == 'boolean':
+                overrides[name] = {'true': True, 'false': False}[value.lower()]
+            elif kind == 'int':
+                overrides[name] = int(value)
+            elif kind == 'float':
+                overrides[name] = float(value)
+            else:
+                overrides[name] = value
+        except (KeyError, ValueError):
+            raise ValueError('Invalid {}: must be {}'.format(name, _TYPES[kind][1])) from None
+    return overrides
+
+
+def settings(autoscaler):
+    """Return the simulation settings of the config-autoscaler keys ``autoscaler``.
+
+    Keys left out of ``autoscaler`` take their Knative defaults, a
+    ``container-concurrency`` key sets the hard limit of the revision.
+    """
+    autoscaler = dict(AUTOSCALER_DEFAULTS, **autoscaler)
+    # The target is computed from the hard limit when the revision sets one.
+    total = float(autoscaler['container-concurrency-target-default'])
+    container_concurrency = float(autoscaler.get('container-concurrency', 0))
+    if container_concurrency > 0:
+        total = min(total, container_concurrency)
+    target = max(0.01, total * float(autoscaler['container-concurrency-target-percentage']) / 100)
+    stable_window = int(parse_duration(autoscaler['stable-window']))
+    return Settings(
+        target=target,
+        total=total,
+        target_burst_capacity=float(autoscaler['target-burst-capacity']),
+        stable_window=stable_window,
+        panic_window=max(1, round(
+            stable_window * float(autoscaler['panic-window-percentage']) / 100)),
+        panic_threshold=float(autoscaler['panic-threshold-percentage']) / 100,
+        max_scale_up_rate=float(autoscaler['max-scale-up-rate']),
+        max_scale_down_rate=float(autoscaler['max-scale-down-rate']),
+        scale_to_zero=autoscaler['enable-scale-to-zero'] == 'true',
+        scale_to_zero_wait=max(parse_duration(autoscaler['scale-to-zero-grace-period']),
+                               parse_duration(autoscaler['scale-to-zero-pod-retention-period'])),
+        initial_scale=int(float(autoscaler['initial-scale'])),
+        max_scale=int(float(autoscaler['max-scale'])),
+        scale_down_delay=int(parse_duration(autoscaler['scale-down-delay'])),
+    )
+
+
+def read_trace(lines, service_time=1.0):
+    """Return the trace read from the CSV ``lines``.
+
+    Raises ValueError when the CSV has no ``rps`` column or a value is missing
+    or not a finite positive number.
+    """
+    reader = csv.DictReader(lines)
+    if 'rps' not in (reader.fieldnames or ()):
+        raise ValueError('The trace has no rps column')
+    rps, concurrency = [], []
+    for line, row in enumerate(reader, start=2):
+        try:
+            # Fields missing from a short row are None.
+            requests = float(row['rps'])
+            offered = float(row['concurrency']) if row.get('concurrency') else \
+                requests * service_time
+        except (TypeError, ValueError):
+            raise ValueError('Invalid number on line {} of the trace'.format(line)) from None
+        if not (math.isfinite(requests) and math.isfinite(offered)):
+            raise ValueError('Invalid number on line {} of the trace'.format(line))
+        if requests < 0 or offered < 0:
+            raise ValueError('Negative value on line {} of the trace'.format(line))
+        rps.append(requests)
+        concurrency.append(offered)
+    return Trace(rps, concurrency)
+
+
+def simulate(trace, settings, cold_start=5.0):
+    """Replay ``trace`` through the KPA configured with ``settings``.
+
+    Pods are ready ``cold_start`` seconds after the autoscaler asks for them.
+    Returns the per second ``Result`` of the simulation.
+    """
+    cold_start = max(0, math.ceil(cold_start))
+    seconds = len(trace.rps)
+    prefix = [0.0]
+    observed, desired_pods, ready_pods, scheduled_pods = [], [], [], []
+    panics, activators, served = [], [], []
+    pending = []  # times at which the pods being started are ready
+    ready = settings.initial_scale
+    desired = ready
+    started = 0
+    backlog = 0.0
+    panic_since = None
+    panic_desired = 0
+    zero_since = None
+    recent = []  # (time, desired) within scale-down-delay
+    for t in range(seconds):
+        ready += sum(1 for at in pending if at <= t)
+        pending = [at for at in pending if at > t]
+        # Queued requests are counted by the activator and queue-proxy.
+        current = trace.concurrency[t] + backlog
+        observed.append(current)
+        prefix.append(prefix[-1] + current)
+        capacity = ready * settings.total
+        backlog = max(0.0, current - capacity)
+        served.append(current - backlog)
+
+        # A request reaching a revision scaled to zero is reported by the
+        # activator straight away, without waiting for the next tick.
+        from_zero = ready + len(pending) == 0 and current > 0
+        if t % TICK == 0 or from_zero:
+            stable = (prefix[-1] - prefix[max(0, len(prefix) - 1 - settings.stable_window)]) / \
+                min(settings.stable_window, t + 1)
+            panic = (prefix[-1] - prefix[max(0, len(prefix) - 1 - settings.panic_window)]) / \
+                min(settings.panic_window, t + 1)
+            ready_count = max(1, ready)
+            max_up = math.ceil(settings.max_scale_up_rate * ready_count)
+            max_down = math.floor(ready_count / settings.max_scale_down_rate)
+            stable_desired = min(max(math.ceil(stable / settings.target), max_down), max_up)
+            panicking_desired = min(max(math.ceil(panic / settings.target), max_down), max_up)
+
+            over_threshold = panic / ready_count / settings.target >= settings.panic_threshold
+            if over_threshold:
+                if panic_since is None:
+                    panic_desired = 0
+                panic_since = t
+            elif panic_since is not None and t - panic_since >= settings.stable_window:
+                # Panic mode ends a stable window after the last panicking tick.
+                panic_since = None
+            if panic_since is not None:
+                # Never scale down while panicking.
+                panic_desired = max(panic_desired, panicking_desired, ready)
+                wanted = panic_desired
+            else:
+                wanted = stable_desired
+
+            recent = [(at, value) for at, value in recent if t - at < settings.scale_down_delay]
+            recent.append((t, wanted))
+            wanted = max(value for _, value in recent)
+            if settings.max_scale:
+                wanted = min(wanted, settings.max_scale)
+            if wanted == 0 and settings.scale_to_zero:
+                # The last pod is kept until the grace period is over.
+                if zero_since is None:
+                    zero_since = t
+                desired = 0 if t - zero_since >= settings.scale_to_zero_wait else 1
+            else:
+                zero_since = None
+                desired = max(wanted, 0 if settings.scale_to_zero else 1)
+
+            scheduled = ready + len(pending)
+            if desired > scheduled:
+                pending.extend([t + cold_start] * (desired - scheduled))
+                started += desired - scheduled
+                if cold_start == 0:
+                    ready += desired - scheduled
+                    pending = []
+            elif desired < scheduled:
+                # The pods still starting are the first to go.
+                dropped = min(scheduled - desired, len(pending))
+                pending = pending[:len(pending) - dropped]
+                ready -= scheduled - desired - dropped
+
+        excess = math.floor(ready * settings.total - observed[-1] - settings.target_burst_capacity)
+        activators.append(ready == 0 or settings.target_burst_capacity == -1 or excess < 0)
+        panics.append(panic_since is not None)
+        desired_pods.append(desired)
+        ready_pods.append(ready)
+        scheduled_pods.append(ready + len(pending))
+
+    return Result(
+        rps=list(trace.rps),
+        observed=observed,
+        desired=desired_pods,
+        ready=ready_pods,
+        scheduled=scheduled_pods,
+        panic=panics,
+        activator=activators,
+        delay=_delays(trace.concurrency, served),
+        pods_started=started,
+    )
+
+
+def _delays(arrived, served):
+    # The queue is served first in, first out: the work arriving in a second
+    # waits until everything received up to then has been served.
+    delays = [0.0] * len(arrived)
+    total = 0.0
+    served_before = 0.0  # work served before second ``done``
+    done = 0
+    for t, work in enumerate(arrived):
+        total += work
+        while done < len(served) and served_before + served[done] < total * (1 - 1e-9):
+            served_before += served[done]
+            done += 1
+        # Work still queued at the end waits at least until then.
+        delays[t] = float(max(0, done - t))
+    return delays
+
+
+def _percentile(values, weights, fraction):
+    total = sum(weights)
+    if not total:
+        return 0.0
+    seen = 0.0
+    for value, weight in sorted(zip(values, weights)):
+        seen += weight
+        if seen >= fraction * total:
+            return value
+    return max(values)
+
+
+def summary(result):
+    """Return the figures of the simulation ``result``.
+
+    Cold starts count the times traffic arrived while no pod was ready, the
+    queueing delays are weighted by the requests received each second.
+    """
+    seconds = len(result.ready)
+    waiting = [bool(observed and not ready)
+               for observed, ready in zip(result.observed, result.ready)]
+    cold_starts = sum(1 for t in range(seconds) if waiting[t] and not (t and waiting[t - 1]))
+    requests = sum(result.rps)
+    delayed = [delay for delay, rps in zip(result.delay, result.rps) if rps]
+    return {
+        'seconds': seconds,
+        'requests': round(requests, 3),
+        'max-pods': max(result.ready, default=0),
+        'mean-pods': round(sum(result.ready) / seconds, 3) if seconds else 0.0,
+        'pod-seconds': sum(result.scheduled),
+        'pods-started': result.pods_started,
+        'cold-starts': cold_starts,
+        'panic-seconds': sum(result.panic),
+        'activator-seconds': sum(result.activator),
+        'queueing-delay-mean': round(sum(
+            delay * rps for delay, rps in zip(result.delay, result.rps)) / requests, 3
+        ) if requests else 0.0,
+        'queueing-delay-p95': round(_percentile(result.delay, result.rps, 0.95), 3),
+        'queueing-delay-max': round(max(delayed, default=0.0), 3),
+    }
+
+
+if __name__ == '__main__':
+    # Offline run: kpa_simulator.py <trace.csv> [option=value...]
+    try:
+        simulated = settings(autoscaler_settings(parse_overrides(sys.argv[2:], option_types())))
+        with open(sys.argv[1], newline='') as f:
+            trace = read_trace(f)
+    except ValueError as e:
+        sys.exit(str(e))
+    print(json.dumps(summary(simulate(trace, simulated)), indent=2))
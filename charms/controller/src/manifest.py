@@ -0,0 +1,198 @@
+# Copyright 2020 Camille Rodriguez
+# See LICENSE file for licensing details.
+
+"""Lazy index of the upstream Knative Serving release manifest.
+
+``serving-core.yaml`` holds every object of a Knative Serving release. It is
+scanned with regular expressions over a memory map, without any YAML parsing,
+to index the byte range of each document by kind and name. A document is only
+parsed when a render asks for it, so the memory used stays flat as the
+manifest grows.
+
+Parsing YAML is slow, the index and every parsed document are therefore
+compiled into JSON snapshots under ``<manifest>.compiled/``, keyed by the
+SHA-256 of the manifest content, so they survive a charm upgrade or a copy
+resetting its modification time. The snapshots can be produced at
+build time by running this module directly, otherwise they are written on
+first use.
+"""
+
+import hashlib
+import json
+import logging
+import mmap
+import os
+import re
+import sys
+from pathlib import Path
+
+import yaml
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever the compiled format changes, so stale snapshots from a
+# previous charm revision are not reused.
+CACHE_FORMAT = 1
+
+_SEPARATOR_RE = re.compile(rb'^---[ \t]*\r?\n', re.M)
+_KIND_RE = re.compile(rb'^kind:[ \t]*["\']?([\w.-]+)', re.M)
+# First ``name`` key directly under the top level ``metadata`` key
+_NAME_RE = re.compile(
+    rb'^metadata:[^\n]*\n(?:(?:[ \t]*(?:#[^\n]*)?|   [^\n]*|  (?!name:)[^\n]*)\n)*?'
+    rb'  name:[ \t]*["\']?([\w.:-]+)',
+    re.M,
+)
+
+# path -> (cache key, {(kind, name): (offset, length)})
+_cache = {}
+# path -> ((modification time, size), cache key), hashed once per process
+_keys = {}
+# (cache key, kind, name) -> parsed document
+_loaded = {}
+
+
+def _loader():
+    # The C loader is an order of magnitude faster but only available when
+    # PyYAML was built against libyaml.
+    return getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def cache_key(path):
+    """Return the cache key of the manifest ``path``, from the SHA-256 of its content."""
+    path = Path(path)
+    stat = path.stat()
+    signature = (stat.st_mtime_ns, stat.st_size)
+    cached = _keys.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    key = '{}:{}'.format(CACHE_FORMAT, hashlib.sha256(path.read_bytes()).hexdigest())
+    _keys[path] = (signature, key)
+    return key
+
+
+def _compiled_dir(path):
+    return path.with_name(path.stem + '.compiled')
+
+
+def _read_compiled(path, key):
+    try:
+        compiled = json.loads(path.read_text())
+    except (OSError, ValueError):
+        return None
+    return compiled if compiled.get('key') == key else None
+
+
+def _write_compiled(path, compiled):
+    tmp = path.with_name(path.name + '.tmp')
+    try:
+        path.parent.mkdir(exist_ok=True)
+        tmp.write_text(json.dumps(compiled, separators=(',', ':')))
+        os.replace(str(tmp), str(path))
+    except OSError:
+        logger.warning('Unable to write compiled manifest %s', path, exc_info=True)
+
+
+def scan(path):
+    """Yield the ``(kind, name, offset, length)`` of every document of ``path``.
+
+    Only the top level ``kind`` and ``metadata.name`` keys are looked at, the
+    documents are not parsed. Documents without both are skipped.
+    """
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        separators = list(_SEPARATOR_RE.finditer(data))
+        starts = [0] + [separator.end() for separator in separators]
+        ends = [separator.start() for separator in separators] + [len(data)]
+        for start, end in zip(starts, ends):
+            kind = _KIND_RE.search(data, start, end)
+            name = _NAME_RE.search(data, start, end)
+            if kind and name:
+                yield kind.group(1).decode(), name.group(1).decode(), start, end - start
+
+
+def _index(path):
+    path = Path(path)
+    key = cache_key(path)
+    cached = _cache.get(path)
+    if cached is not None and cached[0] == key:
+        return cached
+    index_file = _compiled_dir(path) / 'index.json'
+    compiled = _read_compiled(index_file, key)
+    if compiled is not None:
+        index = {tuple(document.split('/', 1)): tuple(bounds)
+                 for document, bounds in compiled['documents'].items()}
+    else:
+        index = {(kind, name): (offset, length)
+                 for kind, name, offset, length in scan(path)}
+        _write_compiled(index_file, {
+            'key': key,
+            'documents': {'{}/{}'.format(*document): bounds
+                          for document, bounds in index.items()},
+        })
+    cached = _cache[path] = (key, index)
+    return cached
+
+
+def names(path, kind):
+    """Return the names of the objects of ``kind`` in the manifest ``path``."""
+    _, index = _index(path)
+    return [name for document_kind, name in index if document_kind == kind]
+
+
+def load(path, kind, name):
+    """Return the object ``kind``/``name`` of the manifest ``path``.
+
+    The returned object is shared between callers and must not be mutated.
+    Raises KeyError when the manifest has no such object.
+    """
+    path = Path(path)
+    key, index = _index(path)
+    offset, length = index[(kind, name)]
+    loaded_key = (key, kind, name)
+    if loaded_key in _loaded:
+        return _loaded[loaded_key]
+    document_file = _compiled_dir(path) / '{}.{}.json'.format(kind, name)
+    compiled = _read_compiled(document_file, key)
+    if compiled is not None:
+        document = compiled['document']
+    else:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            document = yaml.load(f.read(length), Loader=_loader())
+        _write_compiled(document_file, {'key': key, 'document': document})
+    _loaded[loaded_key] = document
+    return document
+
+
+def aggregated_rules(path, name):
+    """Return the rules of the aggregated ClusterRole ``name`` of ``path``.
+
+    The rules are those of the ClusterRoles of the manifest matched by its
+    aggregation rule, as the Kubernetes controller manager would fill them in.
+    """
+    role = load(path, 'ClusterRole', name)
+    selectors = [selector.get('matchLabels', {})
+                 for selector in role['aggregationRule']['clusterRoleSelectors']]
+    rules = list(role.get('rules') or [])
+    for other in names(path, 'ClusterRole'):
+        if other == name:
+            continue
+        aggregated = load(path, 'ClusterRole', other)
+        labels = aggregated['metadata'].get('labels', {})
+        if any(selector.items() <= labels.items() for selector in selectors):
+            rules.extend(aggregated['rules'])
+    return rules
+
+
+def container_image(path, deployment, container):
+    """Return the image of ``container`` in the Deployment ``deployment``."""
+    spec = load(path, 'Deployment', deployment)['spec']['template']['spec']
+    for candidate in spec['containers']:
+        if candidate['name'] == container:
+            return candidate['image']
+    raise KeyError(container)
+
+
+if __name__ == '__main__':
+    # Build-time compilation: manifest.py <serving-core.yaml>
+    for kind, name, _, _ in scan(sys.argv[1]):
+        load(sys.argv[1], kind, name)
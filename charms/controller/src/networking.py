@@ -0,0 +1,137 @@
+# Copyright 2020 Camille Rodriguez
+# See LICENSE file for licensing details.
+
+"""Networking layer plug-ins of the controller charm.
+
+Knative Serving hands its ingresses over to the networking layer selected by
+the ``ingress.class`` key of config-network. Some layers need a Knative
+controller translating the ingresses into their own resources (net-istio,
+net-kourier, net-contour), it runs as a sidecar of the Serving controller and
+shares its service account. The ConfigMaps it watches, besides those of
+Serving, are added to the pod spec along with it: the controller does not
+start while one is missing. The other layers watch the Knative ingresses
+themselves.
+
+The resources of a layer are built once per process and shared between
+renders, they must never be mutated by the caller.
+"""
+
+from collections import namedtuple
+from functools import lru_cache
+
+import knative_common
+
+# The sidecar shares the pod of the controller, it must not bind its ports.
+SIDECAR_METRICS_PORT = 9091
+SIDECAR_PROFILING_PORT = 8009
+
+_ALL_VERBS = ['get', 'list', 'create', 'update', 'delete', 'patch', 'watch']
+
+Plugin = namedtuple('Plugin', ['ingress_class', 'controller', 'rules', 'config_maps'])
+# Networking layer controller running next to the Serving controller
+Controller = namedtuple('Controller', ['name', 'image', 'metrics_domain', 'env'])
+
+# Layer name -> plug-in
+PLUGINS = {
+    'ambassador': Plugin('ambassador.ingress.networking.knative.dev', None, (), {}),
+    'contour': Plugin(
+        'contour.ingress.networking.knative.dev',
+        Controller(
+            'net-contour',
+            'gcr.io/knative-releases/knative.dev/net-contour/cmd/controller:v0.19.0',
+            'knative.dev/net-contour',
+            {},
+        ),
+        ({
+            'apiGroups': ['projectcontour.io'],
+            'resources': ['httpproxies'],
+            'verbs': _ALL_VERBS + ['deletecollection'],
+        },),
+        # ConfigMap config-contour of the net-contour release
+        {'config-contour': {
+            'visibility': (
+                'ExternalIP:\n'
+                '  class: contour-external\n'
+                '  service: contour-external/envoy\n'
+                'ClusterLocal:\n'
+                '  class: contour-internal\n'
+                '  service: contour-internal/envoy\n'
+            ),
+        }},
+    ),
+    'gloo': Plugin('gloo.ingress.networking.knative.dev', None, (), {}),
+    'istio': Plugin(
+        'istio.ingress.networking.knative.dev',
+        Controller(
+            'net-istio',
+            'gcr.io/knative-releases/knative.dev/net-istio/cmd/controller:v0.19.0',
+            'knative.dev/net-istio',
+            {},
+        ),
+        ({
+            'apiGroups': ['networking.istio.io'],
+            'resources': ['virtualservices', 'gateways', 'destinationrules'],
+            'verbs': _ALL_VERBS,
+        },),
+        # ConfigMap config-istio of the net-istio release
+        {'config-istio': {
+            'gateway.knative-serving.knative-ingress-gateway':
+                'istio-ingressgateway.istio-system.svc.cluster.local',
+            'local-gateway.knative-serving.cluster-local-gateway':
+                'cluster-local-gateway.istio-system.svc.cluster.local',
+        }},
+    ),
+    'kong': Plugin('kong', None, (), {}),
+    'kourier': Plugin(
+        'kourier.ingress.networking.knative.dev',
+        Controller(
+            'net-kourier',
+            'gcr.io/knative-releases/knative.dev/net-kourier/cmd/kourier:v0.19.0',
+            'knative.dev/net-kourier',
+            {'KOURIER_GATEWAY_NAMESPACE': 'kourier-system'},
+        ),
+        # The Knative ingresses and the core resources are already granted
+        # to the Serving controller.
+        (),
+        # Configured through its environment, net-kourier v0.19 only watches
+        # the ConfigMaps of Serving.
+        {},
+    ),
+}
+
+Resources = namedtuple('Resources', ['config_network', 'sidecars', 'rules', 'config_maps'])
+
+
+def plugin(layer):
+    """Return the plug-in of the networking ``layer``, raises ValueError if unknown."""
+    try:
+        return PLUGINS[layer.lower()]
+    except KeyError:
+        raise ValueError('Invalid networking layer selected') from None
+
+
+@lru_cache(maxsize=None)
+def resources(layer, registry='', pull_policy=''):
+    """Return the resources the networking ``layer`` adds to the controller.
+
+    The image of the layer controller is pulled from the ``registry`` mirror
+    when set, with ``pull_policy`` unless empty.
+    """
+    selected = plugin(layer)
+    sidecars = []
+    if selected.controller:
+        sidecars.append(knative_common.build_container(
+            selected.controller.name,
+            knative_common.mirror_image(selected.controller.image, registry),
+            env=selected.controller.env,
+            metrics_domain=selected.controller.metrics_domain,
+            metrics_port=SIDECAR_METRICS_PORT,
+            profiling_port=SIDECAR_PROFILING_PORT,
+            image_pull_policy=pull_policy,
+        ))
+    return Resources(
+        config_network={'ingress.class': selected.ingress_class},
+        sidecars=tuple(sidecars),
+        rules=list(selected.rules),
+        config_maps=selected.config_maps,
+    )
@@ -3,262 +3,146 @@
 # See LICENSE file for licensing details.
 
 import logging
-import json
-from hashlib import md5
-import os
-from pathlib import Path
 import yaml
 
-# from oci_image import OCIImageResource, OCIImageResourceError
-
-from ops.charm import CharmBase
-from ops.framework import StoredState
 from ops.main import main
-from ops.model import (
-    ActiveStatus,
-    BlockedStatus,
-    MaintenanceStatus,
-    WaitingStatus,
-)
+
+import knative_common
 
 logger = logging.getLogger(__name__)
 
+# Image of the release, unless the controller publishes another one
+IMAGE = (
+    'gcr.io/knative-releases/knative.dev/serving/cmd/webhook'
+    '@sha256:d27b4495ccc304d5a921d847dd1bce82bd2664ce3e5625b57758ebad03542b5f'
+)
 
-class ServingWebhookCharm(CharmBase):
-    _stored = StoredState()
+COMPONENT = {
+    'name': 'webhook',
+    'ports': {'https-webhook': 8443},
+    'env': {'WEBHOOK_PORT': '8443'},
+    # WIP on the probes : container currently crash when probes are enabled
+    'readiness_probe': {'port': 8443, 'scheme': 'HTTPS', 'periodSeconds': 1},
+    'liveness_probe': {'port': 8443, 'initialDelaySeconds': 20, 'failureThreshold': 6},
+}
 
-    def __init__(self, *args):
-        super().__init__(*args)
-        if not self.unit.is_leader():
-            self.unit.status = WaitingStatus("Waiting for leadership")
-            return
-        # self.image = OCIImageResource(self, 'knative-activator-image')
-        self.framework.observe(self.on.install, self._on_start)
-        # self.framework.observe(self.on.config_changed, self._on_config_changed)
-        # --- initialize states ---
-        # self._stored.set_default(config_hash=self._config_hash())
-        self._stored.set_default(started=False)
-        # -- base values --
-        self._stored.set_default(namespace=os.environ["JUJU_MODEL_NAME"])
-    
-    def _on_start(self, event):
-        """Occurs upon install, start, upgrade, and possibly config changed."""
-        if self._stored.started:
-            return
-        self.unit.status = MaintenanceStatus("Installing Knative Webhook...")
-        # try:
-            #image_info = self.image.fetch()
-        image_info = "gcr.io/knative-releases/knative.dev/serving/cmd/webhook@sha256:d27b4495ccc304d5a921d847dd1bce82bd2664ce3e5625b57758ebad03542b5f"
-        # except OCIImageResourceError:
-        #     logging.exception('An error occured while fetching the image info')
-        #     self.unit.status = BlockedStatus("Error fetching image information")
-        #     return
+# Webhook name -> prefix of its charm options
+WEBHOOKS = {
+    'webhook.serving.knative.dev': 'defaulting',
+    'config.webhook.serving.knative.dev': 'config',
+    'validation.webhook.serving.knative.dev': 'validation',
+}
+# Webhooks invoked for the Knative resources of the user namespaces
+SCOPED_WEBHOOKS = ('webhook.serving.knative.dev', 'validation.webhook.serving.knative.dev')
+FAILURE_POLICIES = ('Fail', 'Ignore')
 
-        self.model.pod.set_spec(
-            {
-                'version': 3,
-                'containers': [{
-                    'name': 'webhook',
-                    'image': image_info,
-                    # 'imageDetails': image_info,
-                    'imagePullPolicy': 'Always',
-                    'ports': [{
-                        'containerPort': 9090,
-                        'name': 'metrics'
-                        },
-                        {
-                        'containerPort': 8008,
-                        'name': 'profiling'
-                        },
-                        {
-                        'containerPort': 8443,
-                        'name': 'https-webhook'
-                        },
-                    ],
-                    'envConfig': {
-                        'POD_NAME':{
-                            'field': {
-                                'path': "metadata.name"
-                            }
-                        },
-                        'SYSTEM_NAMESPACE':{
-                            'field': {
-                                'path': "metadata.namespace"
-                            }
-                        },
-                        'CONFIG_LOGGING_NAME':'config-logging',
-                        'CONFIG_OBSERVABILITY_NAME': 'config-observability',
-                        'METRICS_DOMAIN':'knative.dev/serving',
-                        'WEBHOOK_PORT':'8443',
-                    },
-                    'kubernetes': {
-                        'securityContext': {
-                            'privileged': False,
-                            'readOnlyRootFilesystem': True,
-                            'runAsNonRoot': True,
-                            'capabilities': {
-                                'drop': ['ALL']
-                            }
+
+class ServingWebhookCharm(knative_common.RelatedComponentCharm):
+    COMPONENT = COMPONENT
+    IMAGE = IMAGE
+
+    def _k8s_resources(self):
+        return {
+            'kubernetesResources': {
+                'secrets': [
+                    {
+                        # The data is populated at install time.
+                        'name': 'webhook-certs',
+                    }
+                ],
+                'services': [
+                    {
+                        # Need to create a 2nd service because of bug
+                        # lp:https://bugs.launchpad.net/juju/+bug/1902000
+                        'name': 'webhook',
+                        'spec': {
+                            'ports': knative_common.service_ports({
+                                'https-webhook': (443, 8443),
+                            }),
+                            'selector': {'role': 'webhook'},
+                        }
+                    }
+                ],
+                'mutatingWebhookConfigurations': [
+                    {
+                        'name': 'knative-mutating-webhook-config',
+                        'annotations': {
+                            'juju.io/disable-name-prefix': 'true',
                         },
-                        # WIP on the probes : container currently crash when probes are enabled
-                        'readinessProbe': {
-                            'httpGet': {
-                                'port': 8443,
-                                'scheme': 'HTTPS',
-                                'httpHeaders': [{
-                                    'name': 'k-kubelet-probe',
-                                    'value': 'webhook',
-                                }],
-                            },
-                            'periodSeconds': 1
+                        'webhooks': [
+                            self._webhook('webhook.serving.knative.dev'),
+                        ]
+                    }
+                ],
+                'ValidatingWebhookConfigurations': [
+                    {
+                        'name': 'knative-validation-webhook-config',
+                        'annotations': {
+                            'juju.io/disable-name-prefix': 'true',
                         },
-                        'livenessProbe': {
-                            'initialDelaySeconds': 20,
-                            'failureThreshold': 6,
-                            'httpGet': {
-                                'port': 8443,
-                                'httpHeaders': [{
-                                    'name': 'k-kubelet-probe',
-                                    'value': 'webhook',
-                                }],
-                            }
-                        }
-                    },
-                }],
-            },
-            k8s_resources={
-                'kubernetesResources': {
-                    # This type of resource is not supported by the pod_spec
-                    # 'PodDisruptionBudget': [
-                    #     {
-                    #         'name':'webhook-pdb',
-                    #         'spec': {
-                    #             'minAvailable': '80%',
-                    #             'selector': {
-                    #                 'matchLabels': {
-                    #                     'app': 'webhook'
-                    #                 }
-                    #             }
-                    #         }
-                    #     }
-                    # ],
-                    # Same for 
-                    # apiVersion: autoscaling/v2beta1
-                    # kind: HorizontalPodAutoscaler
-                    # metadata:
-                    #   name: webhook
-                    #   namespace: knative-serving
-                    #   labels:
-                    #     serving.knative.dev/release: "v0.19.0"
-                    # spec:
-                    #   minReplicas: 1
-                    #   maxReplicas: 5
-                    #   scaleTargetRef:
-                    #     apiVersion: apps/v1
-                    #     kind: Deployment
-                    #     name: webhook
-                    #   metrics:
-                    #     - type: Resource
-                    #       resource:
-                    #         name: cpu
-                    #         # Percentage of the requested CPU
-                    #         targetAverageUtilization: 100
-                    'secrets': [
-                        {
-                            # The data is populated at install time.
-                            'name': 'webhook-certs',
-                        }
-                    ],
-                    'services': [
-                        {
-                            # Need to create a 2nd service because of bug 
-                            # lp:https://bugs.launchpad.net/juju/+bug/1902000
-                            'name': 'webhook',
-                            'spec': {
-                                'ports': [
-                                    {
-                                        'name': 'http-metrics',
-                                        'port': 9090,
-                                        'targetPort': 9090,
-                                    },
-                                    {
-                                        'name': 'http-profiling',
-                                        'port': 8008,
-                                        'targetPort': 8008,
-                                    },
-                                    {
-                                        'name': 'https-webhook',
-                                        'port': 443,
-                                        'targetPort': 8443,
-                                    }
-                                ],
-                                'selector': {'role': 'webhook'},
-                            }
-                        }
-                    ],
-                    'mutatingWebhookConfigurations': [
-                        {
-                            'name': 'knative-mutating-webhook-config',
-                            'annotations': {
-                                'juju.io/disable-name-prefix': 'true',
-                            },
-                            'webhooks': [
-                                {
-                                    'name': 'webhook.serving.knative.dev',
-                                    'clientConfig': {
-                                        'service': {
-                                            'name': 'webhook',
-                                            'namespace': self._stored.namespace,
-                                        }
-                                    },
-                                    'admissionReviewVersions': ["v1", "v1beta1"],
-                                    'failurePolicy': 'Fail',
-                                    'sideEffects': 'None',
-                                    'timeoutSeconds': 10,
-                                },
-                            ]
-                        }
-                    ],
-                    'ValidatingWebhookConfigurations': [
-                        {
-                            'name': 'knative-validation-webhook-config',
-                            'annotations': {
-                                'juju.io/disable-name-prefix': 'true',
-                            },
-                            'webhooks': [
-                                {
-                                    'name': 'config.webhook.serving.knative.dev',
-                                    'clientConfig': {
-                                        'service': {
-                                            'name': 'webhook',
-                                            'namespace': self._stored.namespace,
-                                        }
-                                    },
-                                    'admissionReviewVersions': ["v1", "v1beta1"],
-                                    'failurePolicy': 'Fail',
-                                    'sideEffects': 'None',
-                                    'timeoutSeconds': 10,
-                                },
-                                {
-                                    'name': 'validation.webhook.serving.knative.dev',
-                                    'clientConfig': {
-                                        'service': {
-                                            'name': 'webhook',
-                                            'namespace': self._stored.namespace,
-                                        }
-                                    },
-                                    'admissionReviewVersions': ["v1", "v1beta1"],
-                                    'failurePolicy': 'Fail',
-                                    'sideEffects': 'None',
-                                    'timeoutSeconds': 10,
-                                },
-                            ]
-                        }
-                    ]
+                        'webhooks': [
+                            self._webhook('config.webhook.serving.knative.dev'),
+                            self._webhook('validation.webhook.serving.knative.dev'),
+                        ]
+                    }
+                ]
+            }
+        }
+
+    def _check_config(self):
+        """Raise ValueError describing the first invalid option."""
+        super()._check_config()
+        knative_common.validate_scaling(self.model.config)
+        for prefix in WEBHOOKS.values():
+            if not 1 <= self.model.config['{}-webhook-timeout'.format(prefix)] <= 30:
+                raise ValueError('{}-webhook-timeout must be between 1 and 30'.format(prefix))
+            policy = self.model.config['{}-webhook-failure-policy'.format(prefix)]
+            if policy not in FAILURE_POLICIES:
+                raise ValueError('{}-webhook-failure-policy must be Fail or Ignore'.format(prefix))
+        self._label_selector('namespace-selector')
+        self._label_selector('object-selector')
+
+    def _webhook(self, name):
+        prefix = WEBHOOKS[name]
+        webhook = {
+            'name': name,
+            'clientConfig': {
+                'service': {
+                    'name': 'webhook',
+                    'namespace': self._stored.namespace,
                 }
+            },
+            'admissionReviewVersions': ["v1", "v1beta1"],
+            'failurePolicy': self.model.config['{}-webhook-failure-policy'.format(prefix)],
+            'sideEffects': 'None',
+            'timeoutSeconds': self.model.config['{}-webhook-timeout'.format(prefix)],
+        }
+        if name in SCOPED_WEBHOOKS:
+            for option, field in (('namespace-selector', 'namespaceSelector'),
+                                  ('object-selector', 'objectSelector')):
+                selector = self._label_selector(option)
+                if selector:
+                    webhook[field] = selector
+        elif self.model.config['scope-config-webhook']:
+            # The config webhook only validates the ConfigMaps of this namespace.
+            webhook['namespaceSelector'] = {
+                'matchLabels': {'kubernetes.io/metadata.name': self._stored.namespace},
             }
-        )
-        self.unit.status = ActiveStatus("Ready")
+        return webhook
+
+    def _label_selector(self, option):
+        """Return the label selector set in ``option``, raises ValueError if invalid."""
+        value = self.model.config[option]
+        if not value:
+            return None
+        try:
+            selector = yaml.safe_load(value)
+        except yaml.YAMLError:
+            selector = None
+        fields = set(selector) if isinstance(selector, dict) else set()
+        if not fields or fields - {'matchLabels', 'matchExpressions'}:
+            raise ValueError('{} must be a label selector'.format(option))
+        return selector
 
 
 if __name__ == "__main__":
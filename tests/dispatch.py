@@ -0,0 +1,54 @@
+# Copyright 2020 Camille Rodriguez
+# See LICENSE file for licensing details.
+
+"""Dispatch a hook to a charm in a fresh process, as Juju does.
+
+Run as ``python -m tests.dispatch <charm> <hook> [leader]`` from the root of
+the repository. Prints a JSON object holding the measurements of the import
+of the charm module (see ``measure``), the modules of the charm loaded once
+the hook is handled and whether lightkube was loaded.
+"""
+
+import importlib
+import json
+import sys
+from pathlib import Path
+
+from ops.testing import Harness
+
+from .charms import CHARMS, CHARMS_DIR
+from .test_benchmarks import measure
+
+
+def _charm_modules(src):
+    return sorted(name for name, module in sys.modules.items()
+                  if str(Path(getattr(module, '__file__', None) or '/').parent) == src)
+
+
+def _forget_charm_modules(src):
+    for name in _charm_modules(src):
+        del sys.modules[name]
+    return ()
+
+
+def dispatch(name, hook, leader):
+    src = str(CHARMS_DIR / name / 'src')
+    sys.path.insert(0, src)
+    result = {
+        'import': measure(lambda: importlib.import_module('charm'),
+                          lambda: _forget_charm_modules(src)),
+    }
+    harness = Harness(getattr(sys.modules['charm'], CHARMS[name]))
+    harness.set_leader(leader)
+    harness.begin()
+    getattr(harness.charm.on, hook.replace('-', '_')).emit()
+    # ops.main commits the framework after every hook, running pre_commit.
+    harness.framework.commit()
+    harness.cleanup()
+    result['modules'] = _charm_modules(src)
+    result['lightkube'] = 'lightkube' in sys.modules
+    return result
+
+
+if __name__ == '__main__':
+    print(json.dumps(dispatch(sys.argv[1], sys.argv[2], sys.argv[3:] == ['leader'])))
@@ -0,0 +1,227 @@
+# Copyright 2020 Camille Rodriguez
+# See LICENSE file for licensing details.
+
+"""Render benchmarks of the charm hooks, checked against stored baselines.
+
+Every hook is dispatched with the per-process caches dropped, as it would be
+by Juju, and measured for:
+
+* ``time``: best of ``ROUNDS`` runs, in units of a fixed calibration workload
+  timed in the same process, so the baselines carry over between machines;
+* ``peak_kib``: peak of the memory traced while the hook runs;
+* ``blocks``: memory blocks allocated by the hook and still alive after it.
+
+The import of each charm module, paid by every hook dispatched to every unit,
+is measured in a fresh process along with the modules loaded by hooks with
+nothing to do (see ``tests.dispatch``).
+
+A measurement fails when it exceeds its baseline beyond ``TOLERANCE``.
+Run with ``UPDATE_BENCHMARKS=1`` to record new baselines in benchmarks.json
+after an intended change.
+"""
+
+import gc
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import unittest
+from pathlib import Path
+
+from ops.testing import Harness
+
+from .charms import CHARMS, CHARMS_DIR, load_charm, reset_caches
+
+ROOT = Path(__file__).resolve().parent.parent
+BASELINES = Path(__file__).with_name('benchmarks.json')
+UPDATE = bool(os.environ.get('UPDATE_BENCHMARKS'))
+ROUNDS = 5
+# Measurement -> (factor, absolute slack) above the baseline considered a
+# regression, the slack absorbs the noise of small figures.
+TOLERANCE = {'time': (2.0, 0.01), 'peak_kib': (1.25, 8), 'blocks': (1.25, 32)}
+
+
+def _calibration():
+    data = {str(i): [str(j) for j in range(i % 50)] for i in range(2000)}
+    json.loads(json.dumps(data, sort_keys=True))
+
+
+def _best_time(func, setup=None):
+    best = None
+    for _ in range(ROUNDS):
+        args = setup() if setup else ()
+        gc.collect()
+        start = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def measure(func, setup=None):
+    """Return the measurements of ``func``, called with the result of ``setup``."""
+    unit = _best_time(_calibration)
+    elapsed = _best_time(func, setup)
+
+    args = setup() if setup else ()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+    return {
+        'time': round(elapsed / unit, 3),
+        'peak_kib': round((peak - current) / 1024, 1),
+        'blocks': max(blocks, 0),
+    }
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    baselines = {}
+    measured = {}
+
+    @classmethod
+    def setUpClass(cls):
+        if BASELINES.exists():
+            cls.baselines = json.loads(BASELINES.read_text())
+
+    @classmethod
+    def tearDownClass(cls):
+        if UPDATE and cls.measured:
+            baselines = json.loads(BASELINES.read_text()) if BASELINES.exists() else {}
+            baselines.update(cls.measured)
+            BASELINES.write_text(json.dumps(baselines, indent=2, sort_keys=True) + '\n')
+
+    def check(self, name, func, setup=None):
+        self.compare(name, measure(func, setup))
+
+    def compare(self, name, result):
+        if UPDATE:
+            self.measured[name] = result
+            return
+        baseline = self.baselines.get(name)
+        if baseline is None:
+            self.skipTest('No baseline for {}, run with UPDATE_BENCHMARKS=1'.format(name))
+        for key, (factor, slack) in TOLERANCE.items():
+            limit = baseline[key] * factor + slack
+            self.assertLessEqual(
+                result[key], limit,
+                '{} {} regressed: {} against a baseline of {}'.format(
+                    name, key, result[key], baseline[key]))
+
+
+class TestHookBenchmarks(BenchmarkTestCase):
+    def harness(self, name):
+        charm_type = load_charm(name)
+        harness = Harness(charm_type)
+        self.addCleanup(harness.cleanup)
+        harness.set_leader(True)
+        harness.begin()
+        reset_caches(charm_type)
+        return harness
+
+    def installed(self, name):
+        harness = self.harness(name)
+        harness.charm.on.install.emit()
+        harness.charm.on.start.emit()
+        reset_caches(type(harness.charm))
+        return harness
+
+    def check_install(self, name):
+        self.check(
+            '{}.install'.format(name),
+            # The charms relating to the controller first render on start.
+            lambda harness: getattr(harness.charm.on, harness.charm.FIRST_HOOK).emit(),
+            lambda: (self.harness(name),),
+        )
+
+    def check_config_changed(self, name):
+        gogc = iter(range(200, 300))
+        self.check(
+            '{}.config-changed'.format(name),
+            lambda harness: harness.update_config({'gogc': str(next(gogc))}),
+            lambda: (self.installed(name),),
+        )
+
+    def test_install(self):
+        for name in CHARMS:
+            with self.subTest(name):
+                self.check_install(name)
+
+    def test_config_changed(self):
+        for name in CHARMS:
+            with self.subTest(name):
+                self.check_config_changed(name)
+
+
+class TestCRDBenchmarks(BenchmarkTestCase):
+    def setUp(self):
+        self.charm_type = load_charm('controller')
+        # Imported lazily by the charm, registered by load_charm.
+        self.crds = sys.modules['crds']
+        self.source = CHARMS_DIR / 'controller' / 'files' / 'serving-crds.yaml'
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache = Path(directory.name) / 'serving-crds.compiled.json'
+
+    def load(self):
+        return self.crds.load_crds(self.source, self.cache)
+
+    def cold(self):
+        reset_caches(self.charm_type)
+        if self.cache.exists():
+            self.cache.unlink()
+        return ()
+
+    def warm(self):
+        reset_caches(self.charm_type)
+        if not self.cache.exists():
+            self.load()
+            reset_caches(self.charm_type)
+        return ()
+
+    def test_compile(self):
+        self.check('controller.crds-compile', self.load, self.cold)
+
+    def test_compiled_cache(self):
+        self.check('controller.crds-cached', self.load, self.warm)
+
+
+class TestDispatchBenchmarks(BenchmarkTestCase):
+    # Modules of a charm loaded by a hook with nothing to render, the
+    # rendering modules of the controller are imported lazily.
+    STARTUP_MODULES = ['charm', 'knative_common']
+
+    def dispatch(self, name, hook, leader):
+        args = [sys.executable, '-m', 'tests.dispatch', name, hook]
+        if leader:
+            args.append('leader')
+        output = subprocess.run(args, cwd=str(ROOT), check=True,
+                                stdout=subprocess.PIPE, universal_newlines=True).stdout
+        return json.loads(output.splitlines()[-1])
+
+    def test_non_leader(self):
+        for name in CHARMS:
+            with self.subTest(name):
+                result = self.dispatch(name, 'update-status', leader=False)
+                self.assertEqual(result['modules'], self.STARTUP_MODULES)
+                self.assertFalse(result['lightkube'])
+                self.compare('{}.import'.format(name), result['import'])
+
+    def test_no_op_hooks(self):
+        for name in CHARMS:
+            for hook in ('config-changed', 'update-status'):
+                with self.subTest(name, hook=hook):
+                    result = self.dispatch(name, hook, leader=True)
+                    self.assertEqual(result['modules'], self.STARTUP_MODULES)
+                    self.assertFalse(result['lightkube'])
@@ -1,35 +1,1012 @@
 # Copyright 2020 Camille Rodriguez
 # See LICENSE file for licensing details.
 
+import filecmp
+import json
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
-from unittest.mock import Mock
+from pathlib import Path
+from unittest import mock
 
-from ops.testing import Harness
-from charm import KnativeOperatorCharm
+from ops.model import ActiveStatus, BlockedStatus, WaitingStatus
+from ops.testing import ActionFailed, Harness
 
+from .charms import CHARMS, CHARMS_DIR, load_charm
+
+
+class CharmTestCase(unittest.TestCase):
+    name = None
+
+    def setUp(self):
+        self.harness = Harness(load_charm(self.name))
+        self.addCleanup(self.harness.cleanup)
+        self.harness.set_leader(True)
+        self.harness.begin()
+
+    def install(self):
+        # Hooks of a deployment in the order Juju runs them.
+        self.harness.charm.on.install.emit()
+        self.harness.charm.on.config_changed.emit()
+        self.harness.charm.on.start.emit()
+        return self.harness.get_pod_spec()
+
+    def mock_client(self, served=('policy/v1beta1',), resources=None):
+        from lightkube import ApiError
+        from lightkube.codecs import from_dict
+        from lightkube.models.meta_v1 import Status
+
+        client = mock.Mock()
+        client.get.return_value = from_dict({
+            'apiVersion': 'apps/v1',
+            'kind': 'Deployment',
+            'metadata': {'name': self.name},
+            'spec': {
+                'replicas': 1,
+                'selector': {'matchLabels': {'app': self.name}},
+                'template': {'spec': {'containers': [
+                    {'name': self.name, 'resources': resources or {}},
+                ]}},
+            },
+        })
+
+        def list_resources(resource, **kwargs):
+            if resource._api_info.resource.api_version not in served:
+                raise ApiError(status=Status(code=404, message='not found'))
+            return iter(())
+        client.list.side_effect = list_resources
+        patcher = mock.patch('lightkube.Client', return_value=client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return client
+
+
+class CommonTests:
+    """Behaviour shared by the four charms."""
+
+    def test_install(self):
+        spec, k8s_resources = self.install()
+        self.assertEqual(self.harness.charm.unit.status, ActiveStatus('Ready'))
+        self.assertEqual(spec['containers'][0]['name'], self.name)
 
-class TestCharm(unittest.TestCase):
     def test_config_changed(self):
-        harness = Harness(KnativeOperatorCharm)
+        self.install()
+        self.harness.update_config({'gogc': '200'})
+        spec, _ = self.harness.get_pod_spec()
+        env = spec['containers'][0]['envConfig']
+        self.assertEqual(env['GOGC'], '200')
+        self.assertEqual(self.harness.charm.unit.status, ActiveStatus('Ready'))
+
+    def test_spec_not_pushed_when_unchanged(self):
+        self.install()
+        with mock.patch.object(self.harness.charm.model.pod, 'set_spec') as set_spec:
+            self.harness.charm.on.config_changed.emit()
+        set_spec.assert_not_called()
+
+    def test_spec_pushed_once_per_change(self):
+        self.install()
+        set_spec = mock.Mock(wraps=self.harness.charm.model.pod.set_spec)
+        with mock.patch.object(self.harness.charm.model.pod, 'set_spec', set_spec):
+            self.harness.update_config({'gogc': '200'})
+            self.harness.charm.on.config_changed.emit()
+            self.harness.charm.on.upgrade_charm.emit()
+        set_spec.assert_called_once()
+
+    def test_upgrade_pushes_new_render(self):
+        self.install()
+        knative_common = sys.modules[load_charm(self.name).__module__].knative_common
+        build_pod_spec = knative_common.build_pod_spec
+
+        def upgraded(*args, **kwargs):
+            # Rendering changed by the new charm revision, same inputs.
+            spec = build_pod_spec(*args, **kwargs)
+            spec['containers'][0]['envConfig']['UPGRADED'] = 'true'
+            return spec
+        with mock.patch.object(knative_common, 'build_pod_spec', upgraded):
+            self.harness.charm.on.upgrade_charm.emit()
+        spec, _ = self.harness.get_pod_spec()
+        self.assertEqual(spec['containers'][0]['envConfig']['UPGRADED'], 'true')
+
+    def test_spec_digest(self):
+        knative_common = sys.modules[load_charm(self.name).__module__].knative_common
+        spec = {'containers': [{'name': self.name, 'ports': [1, 2]}], 'version': 3}
+        digest = knative_common.spec_digest(spec, {'b': 1, 'a': 2})
+        # Canonical serialisation, the key order does not matter.
+        self.assertEqual(digest, knative_common.spec_digest(
+            {'version': 3, 'containers': [{'ports': [1, 2], 'name': self.name}]},
+            {'a': 2, 'b': 1}))
+        self.assertNotEqual(digest, knative_common.spec_digest(spec, {'b': 1, 'a': 3}))
+        self.assertNotEqual(digest, knative_common.spec_digest(spec))
+
+    def test_go_runtime_options(self):
+        self.install()
+        for config, expected in (
+            ({'cpu-limit': '1500m'}, {'GOMAXPROCS': '2'}),
+            ({'cpu-limit': '250m'}, {'GOMAXPROCS': '1'}),
+            ({'cpu-limit': '2', 'gomaxprocs': 3}, {'GOMAXPROCS': '3'}),
+            ({'gogc': '50', 'gomemlimit': '900MiB'}, {'GOGC': '50', 'GOMEMLIMIT': '900MiB'}),
+        ):
+            with self.subTest(config):
+                self.harness.update_config(config)
+                spec, _ = self.harness.get_pod_spec()
+                env = spec['containers'][0]['envConfig']
+                self.assertLessEqual(expected.items(), env.items())
+                self.harness.update_config(unset=list(config))
+        spec, _ = self.harness.get_pod_spec()
+        self.assertNotIn('GOMAXPROCS', spec['containers'][0]['envConfig'])
+
+    def test_resource_options(self):
+        self.install()
+        knative_common = sys.modules[load_charm(self.name).__module__].knative_common
+        config = dict(self.harness.charm.model.config,
+                      **{'cpu-request': '100m', 'memory-request': '100Mi', 'memory-limit': '1Gi'})
+        self.assertEqual(knative_common.resource_requirements(config), {
+            'requests': {'cpu': '100m', 'memory': '100Mi'},
+            'limits': {'memory': '1Gi'},
+        })
+        for config, message in (
+            ({'cpu-request': 'lots'}, 'cpu-request must be a Kubernetes quantity'),
+            ({'memory-request': '2Gi', 'memory-limit': '1Gi'},
+             'memory-request must not exceed memory-limit'),
+            ({'gomaxprocs': -1}, 'gomaxprocs must not be negative'),
+        ):
+            with self.subTest(config):
+                self.harness.update_config(config)
+                self.assertEqual(self.harness.charm.unit.status, BlockedStatus(message))
+                self.harness.update_config(unset=list(config))
+
+    def test_invalid_config(self):
+        self.install()
+        self.harness.update_config({'cpu-request': '2', 'cpu-limit': '1'})
+        self.assertIsInstance(self.harness.charm.unit.status, BlockedStatus)
+
+    def test_hook_timings_action(self):
+        self.install()
+        self.harness.update_config({'gogc': '200'})
+        output = self.harness.run_action('hook-timings', {'count': 1})
+        timings, = json.loads(output.results['timings'])
+        self.assertEqual(timings['hook'], 'config_changed')
+        self.assertIn('set-spec', timings['phases'])
+        self.assertGreater(timings['sizes']['pod-spec'], 0)
+
+    def test_image_options(self):
+        spec, _ = self.install()
+        container = spec['containers'][0]
+        self.assertEqual(container['imagePullPolicy'], 'IfNotPresent')
+        self.harness.update_config({'image-registry': 'registry.internal:5000/mirror'})
+        spec, _ = self.harness.get_pod_spec()
+        self.assertEqual(spec['containers'][0]['image'],
+                         container['image'].replace('gcr.io', 'registry.internal:5000/mirror'))
+        self.harness.update_config({'image-pull-policy': 'Sometimes'})
+        self.assertEqual(self.harness.charm.unit.status, BlockedStatus(
+            'image-pull-policy must be one of Always, IfNotPresent, Never'))
+
+    def test_image_resource(self):
+        self.install()
+        self.harness.add_oci_resource('knative-{}-image'.format(self.name), {
+            'registrypath': 'registry.internal/{}:dev'.format(self.name),
+            'username': 'user',
+            'password': 'secret',
+        })
+        self.harness.charm.on.upgrade_charm.emit()
+        spec, _ = self.harness.get_pod_spec()
+        container = spec['containers'][0]
+        self.assertEqual(container['imageDetails']['imagePath'],
+                         'registry.internal/{}:dev'.format(self.name))
+        self.assertEqual(container['imagePullPolicy'], 'Always')
+
+    def test_upstream_source_resource(self):
+        spec, _ = self.install()
+        release_image = spec['containers'][0]['image']
+        # Attached by Juju by default, the release image goes through the mirror.
+        self.harness.add_oci_resource('knative-{}-image'.format(self.name), {
+            'registrypath': release_image,
+            'username': '',
+            'password': '',
+        })
+        self.harness.update_config({'image-registry': 'registry.internal'})
+        spec, _ = self.harness.get_pod_spec()
+        self.assertEqual(spec['containers'][0]['image'],
+                         release_image.replace('gcr.io', 'registry.internal'))
+
+    def test_metrics_endpoint(self):
+        self.install()
+        relation_id = self.harness.add_relation('metrics-endpoint', 'prometheus')
+        self.harness.add_relation_unit(relation_id, 'prometheus/0')
+        app_data = self.harness.get_relation_data(relation_id, self.harness.charm.app.name)
+        job, = json.loads(app_data['scrape_jobs'])
+        self.assertIn('*:9090', job['static_configs'][0]['targets'])
+        unit_data = self.harness.get_relation_data(relation_id, self.harness.charm.unit.name)
+        self.assertIn('prometheus_scrape_unit_address', unit_data)
+
+    def test_not_leader(self):
+        harness = Harness(load_charm(self.name))
         self.addCleanup(harness.cleanup)
         harness.begin()
-        self.assertEqual(list(harness.charm._stored.things), [])
-        harness.update_config({"thing": "foo"})
-        self.assertEqual(list(harness.charm._stored.things), ["foo"])
+        self.assertIsInstance(harness.charm.unit.status, WaitingStatus)
+        with self.assertRaises(ActionFailed) as failed:
+            harness.run_action('hook-timings')
+        self.assertEqual(failed.exception.message,
+                         'Hook timings are only recorded on the leader unit')
 
-    def test_action(self):
-        harness = Harness(KnativeOperatorCharm)
-        harness.begin()
-        # the harness doesn't (yet!) help much with actions themselves
-        action_event = Mock(params={"fail": ""})
-        harness.charm._on_fortune_action(action_event)
 
-        self.assertTrue(action_event.set_results.called)
+class RelationTests:
+    """Behaviour of the charms requiring the knative-serving relation."""
+
+    def relate(self, serving_config, ready=True):
+        relation_id = self.harness.add_relation('knative-serving', 'serving-controller')
+        self.harness.add_relation_unit(relation_id, 'serving-controller/0')
+        self.harness.update_relation_data(
+            relation_id, 'serving-controller', self.payload(serving_config, ready))
+        return relation_id
+
+    def payload(self, serving_config, ready=True):
+        knative_common = sys.modules[load_charm(self.name).__module__].knative_common
+        payload = knative_common.relation_payload(serving_config)
+        payload['ready'] = 'true' if ready else 'false'
+        return payload
+
+    def test_serving_relation(self):
+        self.install()
+        serving_config = {
+            'namespace': 'knative-serving',
+            'images': {self.name: 'example.com/{}:test'.format(self.name)},
+            'config_maps': {'logging': 'config-logging-test'},
+        }
+        relation_id = self.relate(serving_config)
+        spec, _ = self.harness.get_pod_spec()
+        container = spec['containers'][0]
+        self.assertEqual(container['image'], 'example.com/{}:test'.format(self.name))
+        self.assertEqual(container['envConfig']['CONFIG_LOGGING_NAME'], 'config-logging-test')
+        # Same digest published again, e.g. after a controller config change
+        # not affecting the shared settings.
+        with mock.patch.object(self.harness.charm, '_on_start') as on_start:
+            self.harness.charm.on['knative-serving'].relation_changed.emit(
+                self.harness.model.get_relation('knative-serving', relation_id),
+                self.harness.model.get_app('serving-controller'))
+        on_start.assert_not_called()
+
+    def test_waits_for_controller(self):
+        # Hook order of a deployment related to the controller in a bundle:
+        # install runs before relation-created.
+        self.harness.charm.on.install.emit()
+        self.assertIsNone(self.harness.get_pod_spec())
+        relation_id = self.harness.add_relation('knative-serving', 'serving-controller')
+        self.harness.charm.on.config_changed.emit()
+        self.harness.charm.on.start.emit()
+        self.assertIsNone(self.harness.get_pod_spec())
+        waiting = WaitingStatus('Waiting for the controller to apply the CRDs and ConfigMaps')
+        self.assertEqual(self.harness.charm.unit.status, waiting)
+        self.harness.add_relation_unit(relation_id, 'serving-controller/0')
+        self.harness.update_relation_data(relation_id, 'serving-controller', self.payload(
+            {'namespace': 'knative-serving'}, ready=False))
+        self.assertIsNone(self.harness.get_pod_spec())
+        self.assertEqual(self.harness.charm.unit.status, waiting)
+        self.harness.update_relation_data(relation_id, 'serving-controller', {'ready': 'true'})
+        self.assertIsNotNone(self.harness.get_pod_spec())
+        self.assertEqual(self.harness.charm.unit.status, ActiveStatus('Ready'))
+
+    def test_published_image_registry(self):
+        self.install()
+        self.relate({'images': {self.name: 'gcr.io/knative/{}'.format(self.name)},
+                     'image_registry': 'mirror.internal'})
+        spec, _ = self.harness.get_pod_spec()
+        self.assertEqual(spec['containers'][0]['image'], 'mirror.internal/knative/' + self.name)
+
+    def test_serving_relation_other_namespace(self):
+        self.install()
+        self.relate({'namespace': 'elsewhere'})
+        self.assertEqual(self.harness.charm.unit.status,
+                         BlockedStatus('The controller runs in elsewhere, not in this model'))
+
+
+class TestController(CommonTests, CharmTestCase):
+    name = 'controller'
+
+    def test_hook_phases(self):
+        self.install()
+        timings = json.loads(self.harness.charm._stored.hook_timings[0])
+        self.assertEqual(timings['hook'], 'install')
+        for name in ('crd-load', 'configmap-read', 'spec-build', 'serialize', 'set-spec'):
+            self.assertIn(name, timings['phases'])
+
+    def test_networking_layer(self):
+        spec, _ = self.install()
+        self.assertEqual([container['name'] for container in spec['containers']],
+                         ['controller', 'net-istio'])
+        self.assertIn('gateway.knative-serving.knative-ingress-gateway',
+                      spec['configMaps']['config-istio'])
+        self.harness.update_config({'networking-layer': 'contour'})
+        spec, _ = self.harness.get_pod_spec()
+        self.assertIn('contour-external/envoy', spec['configMaps']['config-contour']['visibility'])
+        self.assertNotIn('config-istio', spec['configMaps'])
+        self.harness.update_config({'networking-layer': 'Kourier'})
+        spec, _ = self.harness.get_pod_spec()
+        self.assertEqual(spec['configMaps']['config-network']['ingress.class'],
+                         'kourier.ingress.networking.knative.dev')
+        self.assertEqual([container['name'] for container in spec['containers']],
+                         ['controller', 'net-kourier'])
+        self.assertFalse({'config-istio', 'config-contour'} & set(spec['configMaps']))
+        self.harness.update_config({'networking-layer': 'ambassador'})
+        spec, _ = self.harness.get_pod_spec()
+        self.assertEqual(len(spec['containers']), 1)
+        self.assertNotIn('networking', [role['name'] for role in spec['serviceAccount']['roles']])
+
+    def test_invalid_networking_layer(self):
+        self.install()
+        self.harness.update_config({'networking-layer': 'nginx'})
+        self.assertEqual(self.harness.charm.unit.status,
+                         BlockedStatus('Invalid networking layer selected'))
+
+    def test_crds(self):
+        _, k8s_resources = self.install()
+        crds = k8s_resources['kubernetesResources']['customResourceDefinitions']
+        self.assertIn('services.serving.knative.dev', [crd['name'] for crd in crds])
+        for crd in crds:
+            for version in crd['spec']['versions']:
+                self.assertNotIn('schema', version)
+
+    def test_compiled_crds(self):
+        crds = sys.modules['crds']
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        source = Path(directory.name) / 'serving-crds.yaml'
+        shipped = CHARMS_DIR / 'controller' / 'files' / 'serving-crds.yaml'
+        source.write_bytes(shipped.read_bytes())
+        cache = Path(directory.name) / 'serving-crds.compiled.json'
+        # Same content as the shipped CRDs, which may already be loaded.
+        crds._loaded.clear()
+        compiled = crds.load_crds(source, cache)
+        self.assertEqual(json.loads(cache.read_text())['crds'], compiled)
+        stripped = {'additionalPrinterColumns', 'schema', 'subresources'}
+        for crd in compiled:
+            for version in crd['spec']['versions']:
+                self.assertFalse(stripped & set(version))
+        # A new process loads the snapshot without parsing the YAML.
+        crds._loaded.clear()
+        with mock.patch.object(crds, 'compile_crds') as compile_crds:
+            self.assertEqual(crds.load_crds(source, cache), compiled)
+        compile_crds.assert_not_called()
+        # Compiled again once the source changes.
+        crds._loaded.clear()
+        source.write_text(source.read_text().replace('services.serving.knative.dev',
+                                                     'services.example.com'))
+        names = [crd['name'] for crd in crds.load_crds(source, cache)]
+        self.assertIn('services.example.com', names)
+        self.assertNotIn('services.serving.knative.dev', names)
+
+    def test_manifest_cache_key(self):
+        manifest = sys.modules['manifest']
+        source = CHARMS_DIR / 'controller' / 'files' / 'serving-core.yaml'
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        copy = Path(directory.name) / 'serving-core.yaml'
+        copy.write_bytes(source.read_bytes())
+        # Keyed by content, a copy reuses the compiled snapshots.
+        self.assertEqual(manifest.cache_key(copy), manifest.cache_key(source))
+        # Same size and modification time, other content.
+        stat = copy.stat()
+        copy.write_bytes(copy.read_bytes().replace(b'v0.19.0', b'v0.19.9'))
+        os.utime(copy, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        manifest._keys.clear()
+        self.assertNotEqual(manifest.cache_key(copy), manifest.cache_key(source))
+
+    def test_crd_schema_mode(self):
+        self.install()
+        self.harness.update_config({'crd-schema-mode': 'minimal'})
+        _, k8s_resources = self.harness.get_pod_spec()
+        crds = k8s_resources['kubernetesResources']['customResourceDefinitions']
+        for crd in crds:
+            for version in crd['spec']['versions']:
+                self.assertIn('schema', version)
+                self.assertNotIn('additionalPrinterColumns', version)
+                self.assertNotIn('"description"', json.dumps(version['schema']))
+        self.harness.update_config({'crd-schema-mode': 'none'})
+        self.assertIsInstance(self.harness.charm.unit.status, BlockedStatus)
+
+    def test_autoscaler_options(self):
+        self.install()
+        self.harness.update_config({'stable-window': '90s', 'enable-scale-to-zero': False})
+        spec, _ = self.harness.get_pod_spec()
+        autoscaler = spec['configMaps']['config-autoscaler']
+        self.assertEqual(autoscaler['stable-window'], '90s')
+        self.assertEqual(autoscaler['enable-scale-to-zero'], 'false')
+
+    def test_autoscaler_option_coverage(self):
+        configmaps = sys.modules['configmaps']
+        options = self.harness.charm.meta.config
+        rendered = {option.key: name for name, option in configmaps.OPTIONS.items()
+                    if option.config_map == 'config-autoscaler'}
+        # Every key of the upstream config-autoscaler has a charm option,
+        # left unset so the Knative default applies.
+        self.assertEqual(sorted(rendered), sorted(configmaps.AUTOSCALER_DEFAULTS))
+        for name in rendered.values():
+            self.assertIsNone(options[name].default, name)
+
+    def test_autoscaler_typed_options(self):
+        spec, _ = self.install()
+        self.assertEqual(list(spec['configMaps']['config-autoscaler']), ['_example'])
+        self.harness.update_config({
+            'container-concurrency-target-default': 50.5,
+            'target-burst-capacity': -1.0,
+            'initial-scale': 0,
+            'allow-zero-initial-scale': True,
+        })
+        spec, _ = self.harness.get_pod_spec()
+        autoscaler = spec['configMaps']['config-autoscaler']
+        self.assertEqual(autoscaler['container-concurrency-target-default'], '50.5')
+        self.assertEqual(autoscaler['target-burst-capacity'], '-1.0')
+        self.assertEqual(autoscaler['initial-scale'], '0')
+        self.assertEqual(autoscaler['allow-zero-initial-scale'], 'true')
+        self.harness.update_config({'allow-zero-initial-scale': False})
+        self.assertEqual(self.harness.charm.unit.status, BlockedStatus(
+            'Invalid initial-scale: 0 requires allow-zero-initial-scale'))
+
+    def test_api_only_option_skips_render(self):
+        self.install()
+        knative_common = sys.modules[load_charm(self.name).__module__].knative_common
+        with mock.patch.object(knative_common, 'reconcile_deployment') as reconcile, \
+                mock.patch.object(knative_common, 'build_pod_spec') as build_pod_spec:
+            self.harness.update_config({'replicas': 2})
+        reconcile.assert_called_once()
+        build_pod_spec.assert_not_called()
+        self.assertEqual(self.harness.charm.unit.status, ActiveStatus('Ready'))
+
+    def test_replicas_left_to_juju(self):
+        self.install()
+        knative_common = sys.modules[load_charm(self.name).__module__].knative_common
+        client = mock.Mock()
+        client.get.return_value.spec.replicas = 3  # juju scale-application
+        client.get.return_value.spec.template.spec.containers = []
+        config = dict(self.harness.charm.model.config)
+        with mock.patch('lightkube.Client', return_value=client):
+            knative_common.reconcile_deployment(
+                'controller', 'knative-serving', 'controller', dict(config, replicas=0))
+            client.patch.assert_not_called()
+            knative_common.reconcile_deployment(
+                'controller', 'knative-serving', 'controller', dict(config, replicas=2))
+        client.patch.assert_called_once()
+        self.assertEqual(client.patch.call_args[0][2], {'spec': {'replicas': 2}})
+        self.harness.update_config({'replicas': -1})
+        self.assertEqual(self.harness.charm.unit.status,
+                         BlockedStatus('replicas must not be negative'))
+
+    def test_leader_election_options(self):
+        spec, _ = self.install()
+        self.assertNotIn('buckets', spec['configMaps']['config-leader-election'])
+        self.harness.update_config({
+            'leader-election-buckets': 3,
+            'leader-election-lease-duration': '30s',
+            'leader-election-renew-deadline': '20s',
+            'leader-election-retry-period': '5s',
+        })
+        spec, _ = self.harness.get_pod_spec()
+        leader_election = spec['configMaps']['config-leader-election']
+        self.assertEqual(
+            {key: leader_election[key]
+             for key in ('buckets', 'leaseDuration', 'renewDeadline', 'retryPeriod')},
+            {'buckets': '3', 'leaseDuration': '30s', 'renewDeadline': '20s', 'retryPeriod': '5s'})
+        self.assertEqual(self.harness.charm.unit.status, ActiveStatus('Ready'))
+
+    def test_invalid_leader_election_options(self):
+        self.install()
+        ordering = ('Invalid leader election timings: lease duration must exceed '
+                    'renew deadline, which must exceed retry period')
+        for config, message in (
+            ({'leader-election-buckets': 0},
+             'Invalid leader-election-buckets: must be at least 1'),
+            ({'leader-election-buckets': 11},
+             'Invalid leader-election-buckets: must be at most 10'),
+            ({'leader-election-buckets': 10}, None),
+            # Against the Knative defaults of 15s, 10s and 2s.
+            ({'leader-election-lease-duration': '10s'}, ordering),
+            ({'leader-election-renew-deadline': '2s'}, ordering),
+            ({'leader-election-retry-period': '10s'}, ordering),
+            ({'leader-election-lease-duration': '1m', 'leader-election-renew-deadline': '30s',
+              'leader-election-retry-period': '10s'}, None),
+        ):
+            with self.subTest(config):
+                self.harness.update_config(config)
+                self.assertEqual(self.harness.charm.unit.status,
+                                 BlockedStatus(message) if message else ActiveStatus('Ready'))
+                self.harness.update_config(unset=list(config))
 
-    def test_action_fail(self):
-        harness = Harness(KnativeOperatorCharm)
+    def test_invalid_autoscaler_option(self):
+        self.install()
+        self.harness.update_config({'stable-window': '1s'})
+        self.assertEqual(self.harness.charm.unit.status,
+                         BlockedStatus('Invalid stable-window: must be at least 6s'))
+
+    def test_traffic_path_options(self):
+        self.install()
+        self.harness.update_config({
+            'target-burst-capacity': 0.0,
+            'container-concurrency': 10,
+            'revision-timeout-seconds': 60,
+        })
+        spec, _ = self.harness.get_pod_spec()
+        defaults = spec['configMaps']['config-defaults']
+        self.assertEqual(defaults['container-concurrency'], '10')
+        self.assertEqual(defaults['revision-timeout-seconds'], '60')
+        self.assertEqual(spec['configMaps']['config-autoscaler']['target-burst-capacity'], '0.0')
+        self.harness.update_config({'revision-timeout-seconds': 900})
+        self.assertEqual(self.harness.charm.unit.status, BlockedStatus(
+            'Invalid revision-timeout-seconds: must be at most max-revision-timeout-seconds'))
+
+    def test_queue_sidecar_options(self):
+        self.install()
+        self.harness.update_config({
+            'queue-sidecar-memory-request': '50Mi',
+            'registries-skipping-tag-resolving': 'kind.local, registry.internal:5000',
+        })
+        spec, _ = self.harness.get_pod_spec()
+        deployment = spec['configMaps']['config-deployment']
+        self.assertEqual(deployment['queueSidecarMemoryRequest'], '50Mi')
+        self.assertEqual(deployment['registriesSkippingTagResolving'],
+                         'kind.local,registry.internal:5000')
+        self.assertIn('queueSidecarImage', deployment)
+        self.harness.update_config({'queue-sidecar-cpu-limit': '10m'})
+        self.assertEqual(self.harness.charm.unit.status, BlockedStatus(
+            'Invalid queue-sidecar-cpu-limit: must be at least the queue-sidecar-cpu-request'))
+
+    def test_gc_policy_action(self):
+        self.install()
+        self.harness.update_config({
+            'retain-since-create-time': 'disabled',
+            'max-non-active-revisions': '50',
+        })
+        spec, _ = self.harness.get_pod_spec()
+        self.assertEqual(spec['configMaps']['config-gc']['max-non-active-revisions'], '50')
+        output = self.harness.run_action('gc-policy')
+        self.assertEqual(output.results, {
+            'retain-since-create-time': 'disabled',
+            'retain-since-last-active-time': '15h',
+            'min-non-active-revisions': '20',
+            'max-non-active-revisions': '50',
+        })
+
+    def test_invalid_gc_option(self):
+        self.install()
+        self.harness.update_config({
+            'min-non-active-revisions': 10,
+            'max-non-active-revisions': '5',
+        })
+        self.assertEqual(self.harness.charm.unit.status, BlockedStatus(
+            'Invalid min-non-active-revisions: must be at most max-non-active-revisions'))
+
+    def trace(self, rows):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = Path(directory.name) / 'trace.csv'
+        path.write_text('rps\n' + ''.join('{}\n'.format(rps) for rps in rows))
+        return str(path)
+
+    def test_simulate_autoscaler_action(self):
+        self.install()
+        # Idle, then a burst beyond the capacity of the initial pod.
+        trace = self.trace([0] * 120 + [500] * 60 + [0] * 240)
+        default = self.harness.run_action('simulate-autoscaler', {'trace': trace}).results
+        self.assertEqual(default['seconds'], 420)
+        self.assertEqual(default['requests'], 30000)
+        self.assertEqual(default['cold-starts'], 1)
+        self.assertGreaterEqual(default['max-pods'], 8)
+        self.assertGreater(default['queueing-delay-max'], 0)
+        # The idle pod is kept, the burst does not wait for a cold start.
+        self.harness.update_config({'enable-scale-to-zero': False})
+        kept = self.harness.run_action('simulate-autoscaler', {'trace': trace}).results
+        self.assertEqual(kept['cold-starts'], 0)
+        self.assertLess(kept['queueing-delay-max'], default['queueing-delay-max'])
+        # Proposed settings are simulated without being applied.
+        shorter = self.harness.run_action('simulate-autoscaler', {
+            'trace': trace,
+            'config': '{stable-window: 6s, enable-scale-to-zero: true}',
+        }).results
+        self.assertLess(shorter['pod-seconds'], default['pod-seconds'])
+        self.assertFalse(self.harness.charm.model.config['enable-scale-to-zero'])
+
+    def test_simulate_autoscaler_invalid(self):
+        self.install()
+        trace = self.trace([10] * 10)
+        # Second row without its rps field.
+        short = str(Path(trace).with_name('short.csv'))
+        Path(short).write_text('concurrency,rps\n2,10\n3\n')
+        for params, message in (
+            ({'config': '{gogc: 50}'}, 'Not an autoscaler option: gogc'),
+            ({'config': '{stable-window: 1s}'}, 'Invalid stable-window: must be at least 6s'),
+            ({'config': '{stable-window: 60}'}, 'Invalid stable-window: must be a string'),
+            ({'config': '{enable-scale-to-zero: "false"}'},
+             'Invalid enable-scale-to-zero: must be a boolean'),
+            ({'config': '{container-concurrency: 2.5}'},
+             'Invalid container-concurrency: must be an integer'),
+            ({'trace': trace + '.missing'},
+             'Unable to read the trace: No such file or directory'),
+            ({'trace': self.trace([10, 'nan'])}, 'Invalid number on line 3 of the trace'),
+            ({'trace': self.trace(['inf'])}, 'Invalid number on line 2 of the trace'),
+            ({'trace': short}, 'Invalid number on line 3 of the trace'),
+        ):
+            with self.subTest(message):
+                with self.assertRaises(ActionFailed) as failed:
+                    self.harness.run_action(
+                        'simulate-autoscaler', dict({'trace': trace}, **params))
+                self.assertEqual(failed.exception.message, message)
+
+    def test_simulator_command_line(self):
+        script = str(CHARMS_DIR / 'controller' / 'src' / 'kpa_simulator.py')
+        trace = self.trace([10] * 10)
+        run = subprocess.run([sys.executable, script, trace, 'stable-window=6s',
+                              'enable-scale-to-zero=false', 'container-concurrency=5'],
+                             capture_output=True, text=True)
+        self.assertEqual(run.returncode, 0, run.stderr)
+        self.assertEqual(json.loads(run.stdout)['seconds'], 10)
+        for argument, message in (
+            ('stable-window=1s', 'Invalid stable-window: must be at least 6s'),
+            ('bogus-key=3', 'Not an autoscaler option: bogus-key'),
+            ('container-concurrency=2.5', 'Invalid container-concurrency: must be an integer'),
+            ('enable-scale-to-zero=no', 'Invalid enable-scale-to-zero: must be a boolean'),
+        ):
+            with self.subTest(argument):
+                run = subprocess.run([sys.executable, script, trace, argument],
+                                     capture_output=True, text=True)
+                self.assertEqual(run.returncode, 1)
+                self.assertEqual(run.stderr.strip(), message)
+
+    def test_serving_relation(self):
+        self.install()
+        relation_id = self.harness.add_relation('knative-serving', 'serving-activator')
+        data = self.harness.get_relation_data(relation_id, self.harness.charm.app.name)
+        serving_config = json.loads(data['config'])
+        self.assertEqual(serving_config['namespace'], 'knative-serving')
+        self.assertEqual(sorted(serving_config['images']), ['activator', 'autoscaler', 'webhook'])
+        digest = data['digest']
+        self.harness.update_config({'gogc': '200'})
+        self.assertEqual(
+            self.harness.get_relation_data(relation_id, self.harness.charm.app.name)['digest'],
+            digest)
+
+    def test_readiness(self):
+        knative_common = sys.modules[load_charm(self.name).__module__].knative_common
+        missing = mock.Mock(return_value=['config-gc'])
+        with mock.patch.object(knative_common, 'missing_resources', missing):
+            relation_id = self.harness.add_relation('knative-serving', 'serving-activator')
+            self.install()
+            # Checked at the end of every hook, as ops commits the framework.
+            self.harness.framework.commit()
+            data = self.harness.get_relation_data(relation_id, self.harness.charm.app.name)
+            self.assertEqual(data['ready'], 'false')
+            namespace, crds, config_maps = missing.call_args[0]
+            self.assertIn('services.serving.knative.dev', crds)
+            self.assertIn('config-gc', config_maps)
+            # Applied by the time the next hook, whichever it is, ends.
+            missing.return_value = []
+            self.harness.add_relation_unit(relation_id, 'serving-activator/0')
+            self.harness.framework.commit()
+            self.assertEqual(data['ready'], 'true')
+            # Not checked again once applied.
+            missing.reset_mock()
+            self.harness.charm.on.update_status.emit()
+            self.harness.framework.commit()
+            missing.assert_not_called()
+
+    def test_actions_on_non_leader(self):
+        harness = Harness(load_charm(self.name))
+        self.addCleanup(harness.cleanup)
+        harness.update_config({'max-non-active-revisions': '50'})
         harness.begin()
-        action_event = Mock(params={"fail": "fail this"})
-        harness.charm._on_fortune_action(action_event)
+        output = harness.run_action('gc-policy')
+        self.assertEqual(output.results['max-non-active-revisions'], '50')
+        output = harness.run_action('simulate-autoscaler', {'trace': self.trace([10] * 10)})
+        self.assertEqual(output.results['seconds'], 10)
+
+    def test_readiness_not_checked_without_relation(self):
+        self.install()
+        with mock.patch.object(type(self.harness.charm), '_check_config') as check_config, \
+                mock.patch.object(type(self.harness.charm), '_update_readiness') as update:
+            self.harness.charm.on.update_status.emit()
+            self.harness.framework.commit()
+        check_config.assert_not_called()
+        update.assert_not_called()
+
+    def test_observability_options(self):
+        self.install()
+        self.harness.update_config({'enable-profiling': True, 'metrics-backend': 'opencensus'})
+        spec, _ = self.harness.get_pod_spec()
+        observability = spec['configMaps']['config-observability']
+        self.assertEqual(observability['profiling.enable'], 'true')
+        self.assertEqual(observability['metrics.backend-destination'], 'opencensus')
+        self.harness.update_config({'request-metrics-backend': 'graphite'})
+        self.assertIsInstance(self.harness.charm.unit.status, BlockedStatus)
+
+    def test_image_registry(self):
+        self.install()
+        self.harness.update_config({'image-registry': 'mirror.internal'})
+        spec, _ = self.harness.get_pod_spec()
+        queue = spec['configMaps']['config-deployment']['queueSidecarImage']
+        for image in (spec['containers'][1]['image'], queue):
+            self.assertTrue(image.startswith('mirror.internal/knative-releases/'), image)
+
+    def test_sidecar_scraped(self):
+        self.install()
+        relation_id = self.harness.add_relation('metrics-endpoint', 'prometheus')
+        self.harness.add_relation_unit(relation_id, 'prometheus/0')
+        app_data = self.harness.get_relation_data(relation_id, self.harness.charm.app.name)
+        job, = json.loads(app_data['scrape_jobs'])
+        self.assertEqual(job['static_configs'][0]['targets'], ['*:9090', '*:9091'])
+
+    def test_slim_configmaps(self):
+        spec, _ = self.install()
+        self.assertEqual(sorted(spec['configMaps']), sorted(
+            sys.modules['configmaps'].CONFIG_MAPS + ('config-istio',)))
+        full_size = len(json.dumps(spec))
+        self.harness.update_config({'slim-configmaps': True})
+        spec, _ = self.harness.get_pod_spec()
+        for name, data in spec['configMaps'].items():
+            self.assertNotIn('_example', data, name)
+        self.assertLess(len(json.dumps(spec)), full_size - 10000)
+
+    def test_configmap_loader(self):
+        manifest = sys.modules['manifest']
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = Path(directory.name) / 'serving-core.yaml'
+        path.write_bytes((CHARMS_DIR / 'controller' / 'files' / 'serving-core.yaml').read_bytes())
+        # Same content as the shipped manifest, which may already be loaded.
+        manifest._loaded.clear()
+        config_map = manifest.load(path, 'ConfigMap', 'config-gc')
+        self.assertIn('_example', config_map['data'])
+        compiled = Path(directory.name) / 'serving-core.compiled'
+        self.assertTrue((compiled / 'ConfigMap.config-gc.json').exists())
+        with mock.patch.object(manifest.yaml, 'load') as load:
+            # Parsed at most once per process.
+            self.assertIs(manifest.load(path, 'ConfigMap', 'config-gc'), config_map)
+            # Read back from the compiled snapshot by a new process.
+            manifest._cache.clear()
+            manifest._loaded.clear()
+            self.assertEqual(manifest.load(path, 'ConfigMap', 'config-gc'), config_map)
+        load.assert_not_called()
+
+
+class TestActivator(CommonTests, RelationTests, CharmTestCase):
+    name = 'activator'
+
+    def knative_common(self):
+        return sys.modules[load_charm(self.name).__module__].knative_common
+
+    def test_invalid_scaling(self):
+        self.install()
+        self.harness.update_config({'min-replicas': 3, 'max-replicas': 2})
+        self.assertIsInstance(self.harness.charm.unit.status, BlockedStatus)
+        self.harness.update_config({'min-replicas': 1, 'max-replicas': 3})
+        self.assertEqual(self.harness.charm.unit.status,
+                         BlockedStatus('max-replicas above 1 requires cpu-request'))
+
+    def test_scaling_manifests(self):
+        scaling_manifests = self.knative_common().scaling_manifests
+        config = dict(self.harness.charm.model.config, **{'max-replicas': 1})
+        self.assertEqual(scaling_manifests('activator', config, {'app': 'activator'}),
+                         (None, None))
+        config.update({'min-replicas': 2, 'max-replicas': 5, 'cpu-request': '300m'})
+        hpa, pdb = scaling_manifests('activator', config, {'app': 'activator'})
+        self.assertEqual(hpa['spec']['minReplicas'], 2)
+        self.assertEqual(hpa['spec']['maxReplicas'], 5)
+        self.assertEqual(hpa['spec']['targetCPUUtilizationPercentage'], 100)
+        # Same API version as the PDB of the release manifest.
+        self.assertEqual(pdb['apiVersion'], 'policy/v1beta1')
+        self.assertEqual(pdb['spec'], {'minAvailable': '80%',
+                                       'selector': {'matchLabels': {'app': 'activator'}}})
+        config['pdb-min-available'] = '2'
+        _, pdb = scaling_manifests('activator', config, {'app': 'activator'}, 'policy/v1')
+        self.assertEqual(pdb['apiVersion'], 'policy/v1')
+        self.assertEqual(pdb['spec']['minAvailable'], 2)
+        config['pdb-min-available'] = ''
+        self.assertIsNone(scaling_manifests('activator', config, {'app': 'activator'})[1])
+
+    def test_reconcile_deployment(self):
+        self.install()
+        client = self.mock_client()
+        self.harness.update_config({'max-replicas': 3, 'cpu-request': '300m'})
+        self.assertEqual(self.harness.charm.unit.status, ActiveStatus('Ready'))
+        (_, _, patch), kwargs = client.patch.call_args
+        container, = patch['spec']['template']['spec']['containers']
+        self.assertEqual(container['resources'], {
+            'requests': {'cpu': '300m', 'memory': None},
+            'limits': {'cpu': None, 'memory': None},
+        })
+        hpa, pdb = [call[0][0] for call in client.apply.call_args_list]
+        self.assertEqual(hpa.kind, 'HorizontalPodAutoscaler')
+        self.assertEqual(hpa.spec.maxReplicas, 3)
+        self.assertEqual((pdb.apiVersion, pdb.metadata.name),
+                         ('policy/v1beta1', 'activator-pdb'))
+        client.delete.assert_not_called()
+        # Back to a single replica, the HPA and PDB are deleted.
+        client.apply.reset_mock()
+        self.harness.update_config({'max-replicas': 1})
+        client.apply.assert_not_called()
+        self.assertEqual([call[0][1] for call in client.delete.call_args_list],
+                         ['activator', 'activator-pdb'])
+        # Nothing left to clean up, the API is not used anymore.
+        self.harness.update_config({'cpu-request': ''})
+        client.reset_mock()
+        self.harness.update_config({'gogc': '200'})
+        client.get.assert_not_called()
+
+    def test_reconcile_resources(self):
+        self.install()
+        # As returned by the API server, 1000m normalised to 1.
+        client = self.mock_client(resources={'requests': {'cpu': '1', 'memory': '100Mi'}})
+        self.harness.update_config({'cpu-request': '1000m', 'memory-request': '100Mi'})
+        client.patch.assert_not_called()
+        # The memory request is dropped, the CPU request kept.
+        self.harness.update_config({'memory-request': ''})
+        (_, _, patch), _ = client.patch.call_args
+        container, = patch['spec']['template']['spec']['containers']
+        self.assertEqual(container['resources']['requests'], {'cpu': '1000m', 'memory': None})
+
+    def test_reconcile_deployment_pdb_v1(self):
+        self.install()
+        client = self.mock_client(served=('policy/v1', 'policy/v1beta1'))
+        self.harness.update_config({'max-replicas': 3, 'cpu-request': '300m'})
+        _, pdb = [call[0][0] for call in client.apply.call_args_list]
+        self.assertEqual(pdb.apiVersion, 'policy/v1')
+
+    def test_reconcile_deployment_not_created(self):
+        from lightkube import ApiError
+        from lightkube.models.meta_v1 import Status
+
+        self.install()
+        client = self.mock_client()
+        client.get.side_effect = ApiError(status=Status(code=404, message='not found'))
+        self.harness.update_config({'cpu-request': '300m'})
+        client.patch.assert_not_called()
+        self.assertFalse(self.harness.charm._stored.deployment_patched)
+
+
+class TestAutoscaler(CommonTests, RelationTests, CharmTestCase):
+    name = 'autoscaler'
+
+    def test_service(self):
+        spec, k8s_resources = self.install()
+        service, = k8s_resources['kubernetesResources']['services']
+        self.assertEqual(service['name'], 'autoscaler')
+        self.assertIn(8080, [port['port'] for port in service['spec']['ports']])
+        labels = k8s_resources['kubernetesResources']['pod']['labels']
+        self.assertLessEqual(service['spec']['selector'].items(), labels.items())
+        rules = spec['serviceAccount']['roles'][0]['rules']
+        self.assertIn('leases', [resource for rule in rules for resource in rule['resources']])
+
+    def test_replicas_beyond_buckets(self):
+        self.install()
+        self.relate({'leader_election_buckets': 2})
+        with self.assertLogs(level='WARNING') as logs:
+            self.harness.update_config({'replicas': 3})
+        self.assertIn('2 leader election buckets', logs.output[0])
+
+
+class TestWebhook(CommonTests, RelationTests, CharmTestCase):
+    name = 'webhook'
+
+    def webhooks(self, kind):
+        _, k8s_resources = self.harness.get_pod_spec()
+        configuration, = k8s_resources['kubernetesResources'][kind]
+        return {webhook['name']: webhook for webhook in configuration['webhooks']}
+
+    def test_webhook_options(self):
+        self.install()
+        self.harness.update_config({
+            'validation-webhook-timeout': 3,
+            'namespace-selector': '{"matchLabels": {"knative": "enabled"}}',
+        })
+        webhooks = self.webhooks('ValidatingWebhookConfigurations')
+        validation = webhooks['validation.webhook.serving.knative.dev']
+        self.assertEqual(validation['timeoutSeconds'], 3)
+        self.assertEqual(validation['namespaceSelector'], {'matchLabels': {'knative': 'enabled'}})
+        self.assertNotIn('namespaceSelector', webhooks['config.webhook.serving.knative.dev'])
+
+    def test_scaling(self):
+        self.install()
+        client = self.mock_client()
+        self.harness.update_config({'min-replicas': 2, 'max-replicas': 4, 'cpu-request': '100m',
+                                    'pdb-min-available': '1'})
+        self.assertEqual(self.harness.charm.unit.status, ActiveStatus('Ready'))
+        hpa, pdb = [call[0][0] for call in client.apply.call_args_list]
+        self.assertEqual(hpa.metadata.name, 'webhook')
+        self.assertEqual((hpa.spec.minReplicas, hpa.spec.maxReplicas), (2, 4))
+        self.assertEqual(hpa.spec.scaleTargetRef.name, 'webhook')
+        self.assertEqual(pdb.metadata.name, 'webhook-pdb')
+        self.assertEqual(pdb.spec['minAvailable'], 1)
+        self.harness.update_config({'min-replicas': 1, 'max-replicas': 1})
+        self.assertEqual([call[0][1] for call in client.delete.call_args_list],
+                         ['webhook', 'webhook-pdb'])
+
+    def test_failure_policy(self):
+        self.install()
+        self.harness.update_config({'validation-webhook-failure-policy': 'Ignore',
+                                    'defaulting-webhook-timeout': 5})
+        self.assertEqual(
+            self.webhooks('ValidatingWebhookConfigurations')[
+                'validation.webhook.serving.knative.dev']['failurePolicy'], 'Ignore')
+        defaulting = self.webhooks('mutatingWebhookConfigurations')['webhook.serving.knative.dev']
+        self.assertEqual((defaulting['failurePolicy'], defaulting['timeoutSeconds']), ('Fail', 5))
+        for config, message in (
+            ({'config-webhook-failure-policy': 'Retry'},
+             'config-webhook-failure-policy must be Fail or Ignore'),
+            ({'defaulting-webhook-timeout': 31},
+             'defaulting-webhook-timeout must be between 1 and 30'),
+        ):
+            with self.subTest(config):
+                self.harness.update_config(config)
+                self.assertEqual(self.harness.charm.unit.status, BlockedStatus(message))
+                self.harness.update_config(unset=list(config))
+
+    def test_invalid_selector(self):
+        self.install()
+        self.harness.update_config({'object-selector': '[]'})
+        self.assertEqual(self.harness.charm.unit.status,
+                         BlockedStatus('object-selector must be a label selector'))
+
+
+class TestPodSpecBuilder(unittest.TestCase):
+    def setUp(self):
+        self.knative_common = sys.modules[load_charm('controller').__module__].knative_common
+
+    def test_build_pod_spec(self):
+        spec = self.knative_common.build_pod_spec(
+            'example.com/activator@sha256:0', name='activator', ports={'http1': 8012},
+            field_env=('POD_NAME', 'POD_IP'), readiness_probe={'port': 8012},
+            runtime_env={'GOGC': '200'})
+        self.assertEqual(spec['version'], 3)
+        container, = spec['containers']
+        self.assertEqual(container['imagePullPolicy'], 'IfNotPresent')
+        self.assertEqual([port['containerPort'] for port in container['ports']],
+                         [9090, 8008, 8012])
+        env = container['envConfig']
+        self.assertEqual(env['POD_IP'], {'field': {'path': 'status.podIP'}})
+        self.assertNotIn('SYSTEM_NAMESPACE', env)
+        self.assertEqual(env['GOGC'], '200')
+        probe = container['kubernetes']['readinessProbe']['httpGet']
+        self.assertEqual(probe['httpHeaders'], [{'name': 'k-kubelet-probe', 'value': 'activator'}])
+
+    def test_shared_fragments(self):
+        first = self.knative_common.build_container('controller', 'example.com/controller')
+        second = self.knative_common.build_container('webhook', 'example.com/webhook')
+        # Memoized fragments are reused rather than rebuilt on every render.
+        self.assertIs(first['kubernetes']['securityContext'],
+                      second['kubernetes']['securityContext'])
+        self.assertIs(first['envConfig']['POD_NAME'], second['envConfig']['POD_NAME'])
+        self.assertIs(first['ports'][0], second['ports'][0])
+
+    def test_sidecar_ports(self):
+        sidecar = self.knative_common.build_container(
+            'net-istio', 'example.com/net-istio', metrics_port=9091, profiling_port=8009)
+        self.assertEqual(sidecar['envConfig']['METRICS_PROMETHEUS_PORT'], '9091')
+        self.assertEqual(sidecar['envConfig']['PROFILING_PORT'], '8009')
+        spec = self.knative_common.build_pod_spec(
+            'example.com/controller', name='controller', sidecars=[sidecar])
+        self.assertEqual([container['name'] for container in spec['containers']],
+                         ['controller', 'net-istio'])
+
+    def test_mirror_image(self):
+        mirror_image = self.knative_common.mirror_image
+        for image, registry, mirrored in (
+            ('gcr.io/knative/controller', '', 'gcr.io/knative/controller'),
+            ('gcr.io/knative/controller', 'mirror:5000/', 'mirror:5000/knative/controller'),
+            ('localhost/controller', 'mirror', 'mirror/controller'),
+            ('knative/controller', 'mirror/path', 'mirror/path/knative/controller'),
+        ):
+            with self.subTest(image=image, registry=registry):
+                self.assertEqual(mirror_image(image, registry), mirrored)
+
+
+class TestSharedModules(unittest.TestCase):
+    def test_knative_common_in_sync(self):
+        reference = CHARMS_DIR / 'controller' / 'src' / 'knative_common.py'
+        for name in CHARMS:
+            copy = CHARMS_DIR / name / 'src' / 'knative_common.py'
+            self.assertTrue(filecmp.cmp(reference, copy, shallow=False),
+                            '{} is out of sync'.format(copy))
 
-        self.assertEqual(action_event.fail.call_args, [("fail this",)])
+    def test_base_charms_abstract(self):
+        related, component = load_charm('webhook').__mro__[1:3]
+        self.assertEqual(component.__abstractmethods__, {'_on_start'})
+        self.assertEqual(related.__abstractmethods__, {'_k8s_resources'})